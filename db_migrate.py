@@ -0,0 +1,255 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Move the userbot database between SQLite and MongoDB
+
+The source is always the database configured in .env, stop the userbot
+before running this.
+
+    python db_migrate.py copy --to mongodb --url mongodb://... --name Moon_Userbot
+    python db_migrate.py copy --to sqlite3 --name database.db
+    python db_migrate.py verify --to mongodb --url mongodb://... --name Moon_Userbot
+    python db_migrate.py export snapshot.jsonl
+    python db_migrate.py import snapshot.jsonl [--to ... --url ... --name ...]
+
+Copies stream every module in batches and save their progress to a
+checkpoint file, run the same command again to resume an interrupted one.
+After copying, every module is verified by row count and checksum.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+from utils import config
+from utils.db import MongoDatabase, SqliteDatabase, backend
+
+# sections besides the modules
+SETS = "_sets"
+HISTORY = "_chat_history"
+
+
+def open_database(kind: str, url: str, name: str):
+    if kind in ["mongo", "mongodb"]:
+        return MongoDatabase(url, name, config.db_mongo_layout)
+    return SqliteDatabase(name, readers=0)
+
+
+def sections(database) -> list:
+    return database.get_modules() + [SETS, HISTORY]
+
+
+def iter_section(database, section: str, batch_size: int, after=None):
+    """Yield snapshot records of one section, after the record_key ``after``"""
+    if section == SETS:
+        after = tuple(after) if after is not None else None
+        for module, var, members in database.iter_sets(after):
+            members = sorted(members, key=json.dumps)
+            yield {"set": module, "var": var, "members": members}
+    elif section == HISTORY:
+        for user_id, messages in database.iter_chat_histories(after):
+            yield {"user_id": user_id, "messages": messages}
+    else:
+        for var, val in database.iter_collection(section, batch_size, after):
+            yield {"module": section, "var": var, "val": val}
+
+
+def section_of(record: dict) -> str:
+    if "set" in record:
+        return SETS
+    if "user_id" in record:
+        return HISTORY
+    return record["module"]
+
+
+def record_key(record: dict):
+    """Position of a record in its section, used to resume a copy"""
+    if "set" in record:
+        return [record["set"], record["var"]]
+    if "user_id" in record:
+        return record["user_id"]
+    return record["var"]
+
+
+def write_records(database, records: list):
+    """Write records of one section"""
+    values = {}
+    for record in records:
+        if "set" in record:
+            database.sadd(record["set"], record["var"], *record["members"])
+        elif "user_id" in record:
+            # replace, so writing the same history twice doesn't duplicate it
+            database.clear_chat_history(record["user_id"])
+            database._append_chat_history(record["user_id"], record["messages"])
+        else:
+            values[record["var"]] = record["val"]
+    if values:
+        database.set_many(records[0]["module"], values)
+
+
+def batches(records, batch_size: int):
+    batch = []
+    for record in records:
+        if batch and (
+            len(batch) >= batch_size or section_of(batch[0]) != section_of(record)
+        ):
+            yield batch
+            batch = []
+        batch.append(record)
+    if batch:
+        yield batch
+
+
+def summarize(database, batch_size: int) -> dict:
+    """Get row count and order independent checksum of every section"""
+    summary = {}
+    for section in sections(database):
+        count = checksum = 0
+        for record in iter_section(database, section, batch_size):
+            data = json.dumps(record, sort_keys=True, default=str).encode()
+            digest = hashlib.blake2b(data, digest_size=8).digest()
+            checksum = (checksum + int.from_bytes(digest, "big")) % 2**64
+            count += 1
+        if count:
+            summary[section] = (count, checksum)
+    return summary
+
+
+def verify(source, target, batch_size: int) -> bool:
+    expected = summarize(source, batch_size)
+    found = summarize(target, batch_size)
+    ok = True
+    for section in sorted(expected.keys() | found.keys()):
+        if expected.get(section) != found.get(section):
+            ok = False
+            print(
+                f"[!] {section}: expected {expected.get(section, (0, 0))[0]} rows, "
+                f"found {found.get(section, (0, 0))[0]} (or different values)"
+            )
+    if ok:
+        print(f"[*] Verified {len(expected)} sections, everything matches")
+    return ok
+
+
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"done": [], "section": None, "last": None}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def copy(source, target, batch_size: int, checkpoint_path: str) -> bool:
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint["done"] or checkpoint["section"]:
+        print(f"[*] Resuming from {checkpoint_path}")
+
+    for section in sections(source):
+        if section in checkpoint["done"]:
+            continue
+        # section and last are set together once a batch is copied, so any
+        # key is a valid marker, the empty string and 0 included
+        after = checkpoint["last"] if checkpoint["section"] == section else None
+        copied = 0
+        records = iter_section(source, section, batch_size, after)
+        for batch in batches(records, batch_size):
+            write_records(target, batch)
+            target.flush()
+            copied += len(batch)
+            checkpoint.update(section=section, last=record_key(batch[-1]))
+            save_checkpoint(checkpoint_path, checkpoint)
+        checkpoint["done"].append(section)
+        checkpoint.update(section=None, last=None)
+        save_checkpoint(checkpoint_path, checkpoint)
+        print(f"[#] {section}: {copied} rows copied")
+
+    if not verify(source, target, batch_size):
+        return False
+    os.remove(checkpoint_path)
+    return True
+
+
+def export(source, path: str, batch_size: int):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for section in sections(source):
+            for record in iter_section(source, section, batch_size):
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+    print(f"[*] Exported {count} records to {path}")
+
+
+def import_(target, path: str, batch_size: int):
+    count = 0
+    with open(path, encoding="utf-8") as f:
+        records = (json.loads(line) for line in f if line.strip())
+        for batch in batches(records, batch_size):
+            write_records(target, batch)
+            count += len(batch)
+    target.flush()
+    print(f"[*] Imported {count} records from {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--batch-size", type=int, default=500)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_target(command, required=True):
+        command.add_argument(
+            "--to", choices=["sqlite3", "mongo", "mongodb"], required=required
+        )
+        command.add_argument("--url", help="mongodb url")
+        command.add_argument("--name", help="sqlite file or mongodb database name")
+
+    copy_command = commands.add_parser("copy", help="copy into another database")
+    add_target(copy_command)
+    copy_command.add_argument("--checkpoint", default="db_migrate.checkpoint")
+    add_target(commands.add_parser("verify", help="compare with another database"))
+    commands.add_parser("export", help="write a JSONL snapshot").add_argument("file")
+    import_command = commands.add_parser("import", help="load a JSONL snapshot")
+    import_command.add_argument("file")
+    add_target(import_command, required=False)
+
+    args = parser.parse_args()
+    target = None
+    if getattr(args, "to", None):
+        target = open_database(args.to, args.url, args.name or config.db_name)
+
+    if args.command == "copy":
+        ok = copy(backend, target, args.batch_size, args.checkpoint)
+    elif args.command == "verify":
+        ok = verify(backend, target, args.batch_size)
+    elif args.command == "export":
+        export(backend, args.file, args.batch_size)
+        ok = True
+    else:
+        import_(target or backend, args.file, args.batch_size)
+        ok = True
+
+    backend.flush()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -47,14 +47,14 @@ import platform
 
 from pyrogram import Client, idle, errors
 from pyrogram.enums.parse_mode import ParseMode
-from pyrogram.raw.functions.account import GetAuthorizations, DeleteAccount
+from pyrogram.raw.functions.account import DeleteAccount
 import requests
 
 from utils import config
-from utils.db import db
+from utils.db import MongoDatabase, backend, db
 from utils.misc import gitrepo, userbot_version
-from utils.scripts import restart
-from utils.rentry import rentry_cleanup_job
+from utils.scripts import restart, save_authorizations
+from utils.rentry import delete_expired_paste
 from utils.module import ModuleManager
 
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -87,7 +87,7 @@ app = Client(**common_params)
 
 
 def load_missing_modules():
-    all_modules = db.get("custom.modules", "allModules", [])
+    all_modules = db.smembers("custom.modules", "allModules")
     if not all_modules:
         return
 
@@ -154,22 +154,27 @@ async def main():
 
     # required for sessionkiller module
     if db.get("core.sessionkiller", "enabled", False):
-        db.set(
-            "core.sessionkiller",
-            "auths_hashes",
-            [
-                auth.hash
-                for auth in (await app.invoke(GetAuthorizations())).authorizations
-            ],
-        )
+        await save_authorizations(app)
 
     logging.info("Moon-Userbot started!")
 
-    app.loop.create_task(rentry_cleanup_job())
+    if config.db_change_streams and isinstance(backend, MongoDatabase):
+        db.follow(backend, app.loop)
+
+    db.on_expire("core.rentry", delete_expired_paste)
+    app.loop.create_task(db.run_reaper())
+    app.loop.run_in_executor(None, db.migrate_codec)
+    if config.db_maintenance_interval > 0:
+        app.loop.create_task(
+            db.run_maintenance(
+                config.db_maintenance_interval * 60 * 60, config.db_backup_path or None
+            )
+        )
 
     await idle()
 
     await app.stop()
+    await db.aclose()
 
 
 if __name__ == "__main__":
@@ -14,9 +14,12 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import re
+import time
+from collections import deque
 from contextlib import suppress
 
-from pyrogram.enums import ChatType
+from pyrogram.enums import ChatMemberStatus, ChatType
 from pyrogram import Client, ContinuePropagation, filters
 from pyrogram.errors import (
     UserAdminInvalid,
@@ -24,9 +27,10 @@ from pyrogram.errors import (
     RPCError,
 )
 from pyrogram.raw import functions
-from pyrogram.types import Message, ChatPermissions
+from pyrogram.types import ChatMemberUpdated, Message, ChatPermissions
 
-from utils.db import db
+from utils.db import db, DELETED, SET_CHANGED
+from utils.peers import peer_cache
 from utils.scripts import format_exc, with_reply
 from utils.misc import modules_help, prefix
 
@@ -47,39 +51,219 @@ from utils.handlers import (
     AntiRaidHandler,
 )
 
+# tmuted users used to be stored as a list under c<chat_id>
+for _var in list(db.get_collection("core.ats")):
+    if re.fullmatch(r"c-?\d+", _var):
+        db.list_to_set("core.ats", _var)
 
 db_cache: dict = db.get_collection("core.ats")
 
 
-def update_cache():
-    db_cache.clear()
-    db_cache.update(db.get_collection("core.ats"))
+class ChatSettings:
+    """Snapshot of the admintool settings of one chat"""
+
+    __slots__ = (
+        "linked",
+        "antich",
+        "antiraid",
+        "welcome_enabled",
+        "welcome_text",
+        "tmuted",
+        "raidguard",
+        "active",
+    )
+
+    def __init__(self, chat_id: int, tmuted: set):
+        self.linked: int = db_cache.get(f"linked{chat_id}", 0)
+        self.antich: bool = db_cache.get(f"antich{chat_id}", False)
+        self.antiraid: bool = db_cache.get(f"antiraid{chat_id}", False)
+        self.welcome_enabled: bool = db_cache.get(f"welcome_enabled{chat_id}", False)
+        self.welcome_text: str = db_cache.get(f"welcome_text{chat_id}")
+        self.tmuted: frozenset = frozenset(tmuted)
+        self.raidguard: dict = get_raidguard(chat_id)
+        # whether the handler has anything to do in this chat
+        self.active: bool = bool(
+            self.antich
+            or self.antiraid
+            or self.welcome_enabled
+            or self.tmuted
+            or self.raidguard
+        )
+
+
+# chat id -> settings, dropped whenever a setting of the chat changes
+chat_settings = {}
+
+
+def update_cache(_, variable, value):
+    if variable is None:
+        db_cache.clear()
+        db_cache.update(db.get_collection("core.ats"))
+        chat_settings.clear()
+        return
+
+    if value is DELETED:
+        db_cache.pop(variable, None)
+    elif value is not SET_CHANGED:
+        db_cache[variable] = value
+    if chat_id := re.search(r"-?\d+$", variable):
+        chat_settings.pop(int(chat_id.group()), None)
+
+
+db.subscribe("core.ats", update_cache)
+
+
+async def get_chat_settings(chat_id: int) -> ChatSettings:
+    settings = chat_settings.get(chat_id)
+    if settings is None:
+        tmuted = await db.asmembers("core.ats", f"c{chat_id}")
+        settings = chat_settings[chat_id] = ChatSettings(chat_id, tmuted)
+    return settings
+
+
+async def protected_filter(_, __, message: Message):
+    return (await get_chat_settings(message.chat.id)).active
+
+
+protected = filters.create(protected_filter)
+
+# seconds in which messages of one user and joins are counted
+FLOOD_WINDOW = 10
+JOIN_WINDOW = 60
+RAIDGUARD_DEFAULTS = {"messages": 8, "joins": 10, "cooldown": 10 * 60}
+
+
+def get_raidguard(chat_id: int):
+    """Raidguard thresholds of a chat, None if it's disabled"""
+    config = db_cache.get(f"raidguard{chat_id}")
+    if config is None:
+        return None
+    # thresholds that were never set use the defaults
+    return {**RAIDGUARD_DEFAULTS, **config}
+
+
+class RateTracker:
+    """Recent message times of every sender and join times of one chat
+
+    Each is a ring buffer as long as its threshold, which is crossed when the
+    oldest time of a full buffer is still inside the window. Counting a
+    message is O(1), senders gone quiet are dropped once per window.
+    """
+
+    def __init__(self, messages: int, joins: int):
+        self.messages = messages
+        self.senders = {}
+        self.joins = deque(maxlen=joins)
+        self.pruned = time.monotonic()
+        # until when antiraid was enabled by the tracker
+        self.engaged_until = 0
+        self.triggers = 0
+
+    def message(self, sender_id: int, now: float) -> bool:
+        times = self.senders.get(sender_id)
+        if times is None:
+            times = self.senders[sender_id] = deque(maxlen=self.messages)
+        times.append(now)
+        if now - self.pruned > FLOOD_WINDOW:
+            self.prune(now)
+        return len(times) == times.maxlen and now - times[0] <= FLOOD_WINDOW
+
+    def join(self, count: int, now: float) -> bool:
+        self.joins.extend([now] * count)
+        return (
+            len(self.joins) == self.joins.maxlen and now - self.joins[0] <= JOIN_WINDOW
+        )
+
+    def prune(self, now: float):
+        self.pruned = now
+        for sender_id in [
+            sender_id
+            for sender_id, times in self.senders.items()
+            if now - times[-1] > FLOOD_WINDOW
+        ]:
+            del self.senders[sender_id]
+
+    def rates(self, now: float) -> tuple:
+        """Joins in the last minute and the busiest senders"""
+        joins = sum(now - joined <= JOIN_WINDOW for joined in self.joins)
+        senders = sorted(
+            (
+                (sum(now - sent <= FLOOD_WINDOW for sent in times), sender_id)
+                for sender_id, times in self.senders.items()
+            ),
+            reverse=True,
+        )
+        return joins, [(sender_id, count) for count, sender_id in senders if count]
+
+
+# chat id -> rate tracker of chats with raidguard enabled
+rate_trackers = {}
+
+
+def get_rate_tracker(chat_id: int, config: dict) -> RateTracker:
+    tracker = rate_trackers.get(chat_id)
+    if (
+        tracker is None
+        or tracker.messages != config["messages"]
+        or tracker.joins.maxlen != config["joins"]
+    ):
+        tracker = rate_trackers[chat_id] = RateTracker(
+            config["messages"], config["joins"]
+        )
+    return tracker
 
 
-@Client.on_message(filters.group & ~filters.me)
+async def track_raid(message: Message, config: dict) -> bool:
+    """Count the message, returns True if it enabled antiraid"""
+    chat_id = message.chat.id
+    tracker = get_rate_tracker(chat_id, config)
+    now = time.monotonic()
+    sender = message.from_user or message.sender_chat
+    if message.new_chat_members:
+        crossed = tracker.join(len(message.new_chat_members), now)
+    else:
+        crossed = sender is not None and tracker.message(sender.id, now)
+    if not crossed:
+        return False
+
+    engaged = tracker.engaged_until > now
+    if db_cache.get(f"antiraid{chat_id}") and not engaged:
+        # enabled by hand, leave it alone
+        return False
+    # while the raid goes on, the cool-down starts over from time to time
+    if engaged and tracker.engaged_until - now > config["cooldown"] / 2:
+        return False
+
+    tracker.engaged_until = now + config["cooldown"]
+    if not engaged:
+        tracker.triggers += 1
+    await db.aset("core.ats", f"antiraid{chat_id}", True, ttl=config["cooldown"])
+    return not engaged
+
+
+@Client.on_message(filters.group & ~filters.me & protected)
 async def admintool_handler(_, message: Message):
+    settings = await get_chat_settings(message.chat.id)
     if message.sender_chat and (
         message.sender_chat.type == "supergroup"
-        or message.sender_chat.id == db_cache.get(f"linked{message.chat.id}", 0)
+        or message.sender_chat.id == settings.linked
     ):
         raise ContinuePropagation
 
-    if message.sender_chat and db_cache.get(f"antich{message.chat.id}", False):
+    if message.sender_chat and settings.antich:
         with suppress(RPCError):
             await message.delete()
             await message.chat.ban_member(message.sender_chat.id)
 
-    tmuted_users = db_cache.get(f"c{message.chat.id}", [])
-    if (
-        message.from_user
-        and message.from_user.id in tmuted_users
-        or message.sender_chat
-        and message.sender_chat.id in tmuted_users
-    ):
+    if settings.raidguard and await track_raid(message, settings.raidguard):
+        settings = await get_chat_settings(message.chat.id)
+
+    sender = message.from_user or message.sender_chat
+    if sender and sender.id in settings.tmuted:
         with suppress(RPCError):
             await message.delete()
 
-    if db_cache.get(f"antiraid{message.chat.id}", False):
+    if settings.antiraid:
         with suppress(RPCError):
             await message.delete()
             if message.from_user:
@@ -87,14 +271,22 @@ async def admintool_handler(_, message: Message):
             elif message.sender_chat:
                 await message.chat.ban_member(message.sender_chat.id)
 
-    if message.new_chat_members and db_cache.get(
-        f"welcome_enabled{message.chat.id}", False
-    ):
-        await message.reply(
-            db_cache.get(f"welcome_text{message.chat.id}"),
-            disable_web_page_preview=True,
-        )
+    if message.new_chat_members and settings.welcome_enabled:
+        await message.reply(settings.welcome_text, disable_web_page_preview=True)
+
+    raise ContinuePropagation
+
 
+@Client.on_chat_member_updated()
+async def admins_updated(_, update: ChatMemberUpdated):
+    member = update.new_chat_member or update.old_chat_member
+    if member is None:
+        raise ContinuePropagation
+    is_admin = bool(update.new_chat_member) and update.new_chat_member.status in (
+        ChatMemberStatus.OWNER,
+        ChatMemberStatus.ADMINISTRATOR,
+    )
+    peer_cache.update_admin(update.chat.id, (member.user or member.chat).id, is_admin)
     raise ContinuePropagation
 
 
@@ -139,14 +331,12 @@ async def kickdel_cmd(client: Client, message: Message):
 async def tmute_command(client: Client, message: Message):
     handler = TimeMuteHandler(client, message)
     await handler.handle_tmute()
-    update_cache()
 
 
 @Client.on_message(filters.command(["tunmute"], prefix) & filters.me)
 async def tunmute_command(client: Client, message: Message):
     handler = TimeUnmuteHandler(client, message)
     await handler.handle_tunmute()
-    update_cache()
 
 
 @Client.on_message(filters.command(["tmute_users"], prefix) & filters.me)
@@ -183,7 +373,6 @@ async def promote_command(client: Client, message: Message):
 async def anti_channels(client: Client, message: Message):
     handler = AntiChannelsHandler(client, message)
     await handler.handle_anti_channels()
-    update_cache()
 
 
 @Client.on_message(filters.command(["delete_history", "dh"], prefix))
@@ -196,10 +385,10 @@ async def delete_history(client: Client, message: Message):
 @with_reply
 async def report_spam(client: Client, message: Message):
     try:
-        channel = await client.resolve_peer(message.chat.id)
+        channel = await peer_cache.resolve_peer(client, message.chat.id)
 
         user_id, name = await get_user_and_name(message)
-        peer = await client.resolve_peer(user_id)
+        peer = await peer_cache.resolve_peer(client, user_id)
         await client.invoke(
             functions.channels.ReportSpam(
                 channel=channel,
@@ -304,7 +493,96 @@ async def unro(client: Client, message: Message):
 async def antiraid(client: Client, message: Message):
     handler = AntiRaidHandler(client, message)
     await handler.handle_antiraid()
-    update_cache()
+
+
+def format_raidguard(config: dict) -> str:
+    return (
+        f"<b>Messages:</b> <code>{config['messages']}</code> in "
+        f"<code>{FLOOD_WINDOW}s</code> from one user\n"
+        f"<b>Joins:</b> <code>{config['joins']}</code> in <code>{JOIN_WINDOW}s</code>\n"
+        f"<b>Cool-down:</b> <code>{config['cooldown'] // 60} min</code>"
+    )
+
+
+@Client.on_message(filters.command(["raidguard", "rg"], prefix) & filters.me)
+async def raidguard(client: Client, message: Message):
+    if message.chat.type not in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        return await message.edit("<b>Unsupported chat type</b>")
+
+    chat_id = message.chat.id
+    config = get_raidguard(chat_id)
+    args = message.command[1:]
+
+    if not args:
+        if config is None:
+            return await message.edit(
+                "<b>Raidguard is disabled in this chat</b>\n"
+                f"{format_raidguard(RAIDGUARD_DEFAULTS)}\n"
+                f"<b>Enable with: </b><code>{prefix}raidguard on</code>"
+            )
+        return await message.edit(
+            f"<b>Raidguard is enabled in this chat</b>\n{format_raidguard(config)}"
+        )
+
+    if args[0] == "off":
+        db.remove("core.ats", f"raidguard{chat_id}")
+        rate_trackers.pop(chat_id, None)
+        return await message.edit("<b>Raidguard disabled in this chat</b>")
+
+    config = dict(config or RAIDGUARD_DEFAULTS)
+    if args[0] in RAIDGUARD_DEFAULTS:
+        if len(args) < 2 or not args[1].isdigit() or int(args[1]) < 1:
+            return await message.edit(
+                f"<b>Usage: </b><code>{prefix}raidguard {args[0]} [number]</code>"
+            )
+        value = int(args[1])
+        config[args[0]] = value * 60 if args[0] == "cooldown" else value
+    elif args[0] != "on":
+        return await message.edit(
+            f"<b>Usage: </b><code>{prefix}raidguard [on|off|messages|joins|cooldown]</code>"
+        )
+
+    group = await peer_cache.get_chat(client, chat_id)
+    db.set_many(
+        "core.ats",
+        {
+            f"raidguard{chat_id}": config,
+            f"linked{chat_id}": group.linked_chat.id if group.linked_chat else 0,
+        },
+    )
+    await message.edit(
+        f"<b>Raidguard is enabled in this chat</b>\n{format_raidguard(config)}"
+    )
+
+
+@Client.on_message(filters.command(["raidstats", "rst"], prefix) & filters.me)
+async def raidstats(_, message: Message):
+    chat_id = message.chat.id
+    config = get_raidguard(chat_id)
+    if config is None:
+        return await message.edit("<b>Raidguard is disabled in this chat</b>")
+
+    tracker = get_rate_tracker(chat_id, config)
+    now = time.monotonic()
+    joins, senders = tracker.rates(now)
+    text = (
+        f"<b>Joins in the last {JOIN_WINDOW}s:</b> "
+        f"<code>{joins}/{config['joins']}</code>\n"
+    )
+    if senders:
+        text += f"<b>Busiest senders in the last {FLOOD_WINDOW}s:</b>\n"
+        for sender_id, count in senders[:5]:
+            text += f"  <code>{sender_id}</code>: <code>{count}/{config['messages']}</code>\n"
+
+    if tracker.engaged_until > now and db_cache.get(f"antiraid{chat_id}"):
+        minutes, seconds = divmod(int(tracker.engaged_until - now), 60)
+        text += f"<b>Antiraid:</b> <code>on for {minutes}:{seconds:02}</code>\n"
+    elif db_cache.get(f"antiraid{chat_id}"):
+        text += "<b>Antiraid:</b> <code>on</code>\n"
+    else:
+        text += "<b>Antiraid:</b> <code>off</code>\n"
+    text += f"<b>Triggered:</b> <code>{tracker.triggers}</code> time(s)"
+    await message.edit(text)
 
 
 @Client.on_message(filters.command(["welcome", "wc"], prefix) & filters.me)
@@ -314,8 +592,13 @@ async def welcome(_, message: Message):
 
     if len(message.command) > 1:
         text = message.text.split(maxsplit=1)[1]
-        db.set("core.ats", f"welcome_enabled{message.chat.id}", True)
-        db.set("core.ats", f"welcome_text{message.chat.id}", text)
+        db.set_many(
+            "core.ats",
+            {
+                f"welcome_enabled{message.chat.id}": True,
+                f"welcome_text{message.chat.id}": text,
+            },
+        )
 
         await message.edit(
             f"<b>Welcome enabled in this chat\nText:</b> <code>{text}</code>"
@@ -324,22 +607,21 @@ async def welcome(_, message: Message):
         db.set("core.ats", f"welcome_enabled{message.chat.id}", False)
         await message.edit("<b>Welcome disabled in this chat</b>")
 
-    update_cache()
-
 
 modules_help["admintool"] = {
-    "ban [reply]/[username/id]* [reason] [report_spam] [delete_history]": "ban user in chat",
+    "ban [reply]/[username/id...]* [reason] [report_spam] [delete_history]": "ban users in chat. "
+    "Takes several usernames/ids, or replied message of yours listing them",
     "unban [reply]/[username/id]* [reason]": "unban user in chat",
-    "kick [reply]/[userid]* [reason] [report_spam] [delete_history]": "kick user out of chat",
-    "mute [reply]/[userid]* [reason] [1m]/[1h]/[1d]/[1w]": "mute user in chat",
+    "kick [reply]/[username/id...]* [reason] [report_spam] [delete_history]": "kick users out of chat",
+    "mute [reply]/[username/id...]* [reason] [1m]/[1h]/[1d]/[1w]": "mute users in chat",
     "unmute [reply]/[userid]* [reason]": "unmute user in chat",
-    "promote [reply]/[userid]* [prefix]": "promote user in chat",
+    "promote [reply]/[username/id...]* [prefix]": "promote users in chat",
     "demote [reply]/[userid]* [reason]": "demote user in chat",
     "tmute [reply]/[username/id]* [reason]": "delete all new messages from user in chat",
     "tunmute [reply]/[username/id]* [reason]": "stop deleting all messages from user in chat",
     "tmute_users": "list of tmuted (.tmute) users",
     "antich [enable/disable]": "turn on/off blocking channels in this chat",
-    "delete_history [reply]/[username/id]* [reason]": "delete history from member in chat",
+    "delete_history [reply]/[username/id...]* [reason]": "delete history from members in chat",
     "report_spam [reply]*": "report spam message in chat",
     "pin [reply]*": "Pin replied message",
     "unpin [reply]*": "Unpin replied message",
@@ -350,4 +632,9 @@ modules_help["admintool"] = {
     "welcome [text]*": "enable auto-welcome to new users in groups. "
     "Running without text equals to disable",
     "kickdel": "Kick all deleted accounts",
+    "raidguard [on|off]": "turn on/off enabling antiraid automatically on floods and mass joins. "
+    "Running without arguments shows the thresholds",
+    "raidguard [messages|joins|cooldown] [number]": "set the messages from one user in 10 seconds, "
+    "joins in a minute or cool-down minutes that trigger or release antiraid",
+    "raidstats": "show current message and join rates in this chat",
 }
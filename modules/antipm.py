@@ -21,19 +21,49 @@ from pyrogram.raw import functions
 from pyrogram.types import Message
 
 from utils.config import pm_limit
-from utils.db import db
+from utils.db import db, DELETED
 from utils.misc import modules_help, prefix
 
-anti_pm_enabled = filters.create(
-    lambda _, __, ___: db.get("core.antipm", "status", False)
-)
+# warnings are forgotten a day after the last one
+WARNINGS_TTL = 24 * 60 * 60
+
+db_cache: dict = db.get_collection("core.antipm")
+
+
+def update_cache(_, variable, value):
+    if variable is None:
+        db_cache.clear()
+        db_cache.update(db.get_collection("core.antipm"))
+    elif value is DELETED:
+        db_cache.pop(variable, None)
+    else:
+        db_cache[variable] = value
+
+
+db.subscribe("core.antipm", update_cache)
+
+
+def get_warnings(user_id: int) -> int:
+    return db_cache.get(f"warns{user_id}", 0)
+
+
+async def set_warnings(user_id: int, warnings: int):
+    if warnings:
+        await db.aset("core.antipm", f"warns{user_id}", warnings, ttl=WARNINGS_TTL)
+    elif f"warns{user_id}" in db_cache:
+        await db.aremove("core.antipm", f"warns{user_id}")
+
+
+async def anti_pm_enabled_filter(_, __, ___):
+    return db_cache.get("status", False)
+
+
+anti_pm_enabled = filters.create(anti_pm_enabled_filter)
 
 in_contact_list = filters.create(lambda _, __, message: message.from_user.is_contact)
 
 is_support = filters.create(lambda _, __, message: message.chat.is_support)
 
-USER_WARNINGS = {}
-
 
 @Client.on_message(
     filters.private
@@ -46,11 +76,13 @@ USER_WARNINGS = {}
 async def anti_pm_handler(client: Client, message: Message):
     user_id = message.from_user.id
     ids = message.chat.id
-    b_f = await client.get_me()
-    u_n = b_f.first_name
-    user = await client.get_users(ids)
-    u_f = user.first_name
-    default_text = db.get("core.antipm", "antipm_msg", None)
+    if db_cache.get(f"allowusers{ids}") == user_id:
+        return
+
+    u_n = client.me.first_name
+    u_f = message.from_user.first_name
+    warnings = get_warnings(user_id)
+    default_text = db_cache.get("antipm_msg")
     if default_text is None:
         default_text = f"""<b>Hello, {u_f}!
 This is the Assistant Of {u_n}.</b>
@@ -58,43 +90,33 @@ This is the Assistant Of {u_n}.</b>
 Do not spam further messages else I may have to block you!</i>
 
 <b>This is an automated message by the assistant.</b>
-<b><u>Currently You Have <code>{USER_WARNINGS.get(user_id, 0)}</code> Warnings.</u></b>
+<b><u>Currently You Have <code>{warnings}</code> Warnings.</u></b>
     """
     else:
-        default_text = default_text.format(
-            user=u_f, my_name=u_n, warns=USER_WARNINGS.get(user_id, 0)
-        )
+        default_text = default_text.format(user=u_f, my_name=u_n, warns=warnings)
 
-    if db.get("core.antipm", "spamrep", False):
+    if db_cache.get("spamrep", False):
         user_info = await client.resolve_peer(ids)
         await client.invoke(functions.messages.ReportSpam(peer=user_info))
 
-    if db.get("core.antipm", "block", False):
+    if db_cache.get("block", False):
         await client.block_user(user_id)
 
-    if db.get("core.antipm", f"disallowusers{ids}") == user_id != db.get(
-        "core.antipm", f"allowusers{ids}"
-    ) or db.get("core.antipm", f"disallowusers{ids}") != user_id != db.get(
-        "core.antipm", f"allowusers{ids}"
-    ):
-        default_pic = db.get("core.antipm", "antipm_pic", None)
-        if default_pic and os.path.exists(default_pic):
-            await client.send_photo(message.chat.id, default_pic, caption=default_text)
-        else:
-            await client.send_message(message.chat.id, default_text)
-
-        if user_id in USER_WARNINGS:
-            USER_WARNINGS[user_id] += 1
-        else:
-            USER_WARNINGS[user_id] = 1
+    default_pic = db_cache.get("antipm_pic")
+    if default_pic and os.path.exists(default_pic):
+        await client.send_photo(message.chat.id, default_pic, caption=default_text)
+    else:
+        await client.send_message(message.chat.id, default_text)
 
-        if USER_WARNINGS[user_id] > pm_limit:
-            await client.send_message(
-                message.chat.id,
-                "<b>Ehm...! That was your Last warn, Bye Bye see you L0L</b>",
-            )
-            await client.block_user(user_id)
-            del USER_WARNINGS[user_id]
+    if warnings + 1 > pm_limit:
+        await client.send_message(
+            message.chat.id,
+            "<b>Ehm...! That was your Last warn, Bye Bye see you L0L</b>",
+        )
+        await client.block_user(user_id)
+        await set_warnings(user_id, 0)
+    else:
+        await set_warnings(user_id, warnings + 1)
 
 
 @Client.on_message(filters.command(["antipm", "anti_pm"], prefix) & filters.me)
@@ -171,8 +193,7 @@ async def add_contact(_, message: Message):
     ids = message.chat.id
 
     db.set("core.antipm", f"allowusers{ids}", ids)
-    if ids in USER_WARNINGS:
-        del USER_WARNINGS[ids]
+    await set_warnings(ids, 0)
     await message.edit("User Approved!")
 
 
@@ -0,0 +1,87 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from datetime import datetime
+
+import humanize
+from pyrogram import Client, filters
+from pyrogram.types import Message
+
+from utils import config
+from utils.db import db
+from utils.misc import modules_help, prefix
+from utils.scripts import format_exc
+
+
+def format_maintenance(metrics: dict) -> str:
+    text = (
+        f"<b>Last maintenance:</b> "
+        f"<code>{datetime.fromtimestamp(metrics['started']):%Y-%m-%d %H:%M}</code>\n"
+        f"<b>Took:</b> <code>{metrics['duration']}s</code>\n"
+        f"<b>Size:</b> <code>{humanize.naturalsize(metrics['size_before'])}</code> → "
+        f"<code>{humanize.naturalsize(metrics['size_after'])}</code>\n"
+        f"<b>Freed pages:</b> <code>{metrics['freed_pages']}</code>\n"
+    )
+    if metrics.get("converted"):
+        text += "<b>Converted to incremental vacuum</b>\n"
+    if metrics.get("backup"):
+        text += (
+            f"<b>Backup:</b> <code>{metrics['backup']}</code> "
+            f"(<code>{metrics['backup_duration']}s</code>)\n"
+        )
+    return text
+
+
+@Client.on_message(filters.command(["dbstats"], prefix) & filters.me)
+async def dbstats(_, message: Message):
+    try:
+        modules = await asyncio.to_thread(db.get_modules)
+        text = (
+            f"<b>Database:</b> <code>{config.db_type}</code>\n"
+            f"<b>Modules:</b> <code>{len(modules)}</code>\n"
+        )
+        if metrics := await db.aget("core.database", "maintenance"):
+            text += format_maintenance(metrics)
+        await message.edit(text)
+    except Exception as e:
+        await message.edit(format_exc(e))
+
+
+@Client.on_message(filters.command(["dbmaint"], prefix) & filters.me)
+async def dbmaint(_, message: Message):
+    backup_path = config.db_backup_path or None
+    if len(message.command) > 1 and message.command[1] == "backup":
+        backup_path = backup_path or f"{config.db_name}.bak"
+
+    await message.edit("<b>Running database maintenance...</b>")
+    try:
+        metrics = await asyncio.to_thread(db.maintain, backup_path, True)
+    except Exception as e:
+        return await message.edit(format_exc(e))
+
+    if not metrics:
+        return await message.edit("<b>This database doesn't need maintenance</b>")
+    await db.aset("core.database", "maintenance", metrics)
+    await message.edit(format_maintenance(metrics))
+
+
+modules_help["database"] = {
+    "dbstats": "Show database info and the last maintenance run",
+    "dbmaint [backup]": "Compact the database now, the first run on an old "
+    "database rebuilds it once. With backup, also back it up "
+    "to DB_BACKUP_PATH (or next to the database file)",
+}
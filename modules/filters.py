@@ -14,6 +14,8 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections import OrderedDict, deque
+
 from pyrogram import Client, ContinuePropagation, errors, filters
 from pyrogram.types import (
     InputMediaAudio,
@@ -24,6 +26,7 @@ from pyrogram.types import (
 )
 
 from utils.db import db
+from utils.handlers import payload_cache
 from utils.misc import modules_help, prefix
 from utils.scripts import format_exc
 
@@ -36,94 +39,219 @@ def set_filters_chat(chat_id, filters_):
     return db.set("core.filters", f"{chat_id}", filters_)
 
 
+async def aget_filters_chat(chat_id):
+    return await db.aget("core.filters", f"{chat_id}", {})
+
+
+MATCH_MODES = {"-e": "exact", "-w": "word", "-c": "contains"}
+
+
+class TriggerIndex:
+    """Triggers of one chat
+
+    Exact triggers are looked up in a dict, word and substring triggers are
+    all found with one Aho-Corasick pass over the message.
+    """
+
+    def __init__(self, chat_filters: dict):
+        self.filters = chat_filters
+        self.exact = {}
+        patterns = []
+        for name, value in chat_filters.items():
+            if value.get("MATCH", "exact") == "exact":
+                self.exact[name] = value
+            else:
+                patterns.append(name)
+
+        # goto, fail and output of every state, state 0 is the root
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(pattern)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] += self._output[self._fail[child]]
+
+    def match(self, text: str):
+        """Get the name of the first trigger found in text"""
+        if not self.filters:
+            return None
+        text = text.lower()
+        if text in self.exact:
+            return text
+
+        state = 0
+        for end, char in enumerate(text, start=1):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for name in self._output[state]:
+                if self.filters[name]["MATCH"] == "contains":
+                    return name
+                start = end - len(name)
+                if not (
+                    (start > 0 and is_word(text[start - 1]))
+                    or (end < len(text) and is_word(text[end]))
+                ):
+                    return name
+        return None
+
+
+def is_word(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+# chat id -> trigger index of the last chats with filters, dropped whenever
+# the chat's filters change
+trigger_indexes = OrderedDict()
+MAX_TRIGGER_INDEXES = 256
+# shared by every chat without filters, those aren't cached
+EMPTY_INDEX = TriggerIndex({})
+
+
+def drop_trigger_index(_, variable, __):
+    if variable is None:
+        trigger_indexes.clear()
+    else:
+        trigger_indexes.pop(variable, None)
+
+
+db.subscribe("core.filters", drop_trigger_index)
+db.subscribe("core.filters", payload_cache.drop)
+
+
+async def get_trigger_index(chat_id) -> TriggerIndex:
+    index = trigger_indexes.get(str(chat_id))
+    if index is not None:
+        trigger_indexes.move_to_end(str(chat_id))
+        return index
+
+    chat_filters = await aget_filters_chat(chat_id)
+    if not chat_filters:
+        return EMPTY_INDEX
+    index = trigger_indexes[str(chat_id)] = TriggerIndex(chat_filters)
+    if len(trigger_indexes) > MAX_TRIGGER_INDEXES:
+        trigger_indexes.popitem(last=False)
+    return index
+
+
 async def contains_filter(_, __, m):
-    return m.text and m.text.lower() in get_filters_chat(m.chat.id).keys()
+    """Match a trigger, its name and value are kept in m.filter_match"""
+    if not m.text:
+        return False
+    index = await get_trigger_index(m.chat.id)
+    name = index.match(m.text)
+    if name is None:
+        return False
+    # the index may be dropped before the handler runs, keep what matched
+    m.filter_match = (name, index.filters[name])
+    return True
 
 
 contains = filters.create(contains_filter)
 
 
-# noinspection PyTypeChecker
-@Client.on_message(contains)
-async def filters_main_handler(client: Client, message: Message):
-    value = get_filters_chat(message.chat.id)[message.text.lower()]
-    try:
-        await client.get_messages(int(value["CHAT_ID"]), int(value["MESSAGE_ID"]))
-    except errors.RPCError as exc:
-        raise ContinuePropagation from exc
-
-    if value.get("MEDIA_GROUP"):
-        messages_grouped = await client.get_media_group(
-            int(value["CHAT_ID"]), int(value["MESSAGE_ID"])
-        )
-        media_grouped_list = []
-        for _ in messages_grouped:
-            if _.photo:
-                if _.caption:
+def prepare_media_group(messages_grouped) -> list:
+    media_grouped_list = []
+    for _ in messages_grouped:
+        if _.photo:
+            if _.caption:
+                media_grouped_list.append(
+                    InputMediaPhoto(_.photo.file_id, _.caption.HTML)
+                )
+            else:
+                media_grouped_list.append(InputMediaPhoto(_.photo.file_id))
+        elif _.video:
+            if _.caption:
+                if _.video.thumbs:
                     media_grouped_list.append(
-                        InputMediaPhoto(_.photo.file_id, _.caption.HTML)
-                    )
-                else:
-                    media_grouped_list.append(InputMediaPhoto(_.photo.file_id))
-            elif _.video:
-                if _.caption:
-                    if _.video.thumbs:
-                        media_grouped_list.append(
-                            InputMediaVideo(
-                                _.video.file_id,
-                                _.video.thumbs[0].file_id,
-                                _.caption.HTML,
-                            )
+                        InputMediaVideo(
+                            _.video.file_id,
+                            _.video.thumbs[0].file_id,
+                            _.caption.HTML,
                         )
-                    else:
-                        media_grouped_list.append(
-                            InputMediaVideo(_.video.file_id, _.caption.HTML)
-                        )
-                elif _.video.thumbs:
-                    media_grouped_list.append(
-                        InputMediaVideo(_.video.file_id, _.video.thumbs[0].file_id)
                     )
                 else:
-                    media_grouped_list.append(InputMediaVideo(_.video.file_id))
-            elif _.audio:
-                if _.caption:
                     media_grouped_list.append(
-                        InputMediaAudio(_.audio.file_id, _.caption.HTML)
+                        InputMediaVideo(_.video.file_id, _.caption.HTML)
                     )
-                else:
-                    media_grouped_list.append(InputMediaAudio(_.audio.file_id))
-            elif _.document:
-                if _.caption:
-                    if _.document.thumbs:
-                        media_grouped_list.append(
-                            InputMediaDocument(
-                                _.document.file_id,
-                                _.document.thumbs[0].file_id,
-                                _.caption.HTML,
-                            )
-                        )
-                    else:
-                        media_grouped_list.append(
-                            InputMediaDocument(_.document.file_id, _.caption.HTML)
-                        )
-                elif _.document.thumbs:
+            elif _.video.thumbs:
+                media_grouped_list.append(
+                    InputMediaVideo(_.video.file_id, _.video.thumbs[0].file_id)
+                )
+            else:
+                media_grouped_list.append(InputMediaVideo(_.video.file_id))
+        elif _.audio:
+            if _.caption:
+                media_grouped_list.append(
+                    InputMediaAudio(_.audio.file_id, _.caption.HTML)
+                )
+            else:
+                media_grouped_list.append(InputMediaAudio(_.audio.file_id))
+        elif _.document:
+            if _.caption:
+                if _.document.thumbs:
                     media_grouped_list.append(
                         InputMediaDocument(
-                            _.document.file_id, _.document.thumbs[0].file_id
+                            _.document.file_id,
+                            _.document.thumbs[0].file_id,
+                            _.caption.HTML,
                         )
                     )
                 else:
-                    media_grouped_list.append(InputMediaDocument(_.document.file_id))
-        await client.send_media_group(
-            message.chat.id, media_grouped_list, reply_to_message_id=message.id
-        )
-    else:
-        await client.copy_message(
-            message.chat.id,
-            int(value["CHAT_ID"]),
-            int(value["MESSAGE_ID"]),
-            reply_to_message_id=message.id,
-        )
+                    media_grouped_list.append(
+                        InputMediaDocument(_.document.file_id, _.caption.HTML)
+                    )
+            elif _.document.thumbs:
+                media_grouped_list.append(
+                    InputMediaDocument(_.document.file_id, _.document.thumbs[0].file_id)
+                )
+            else:
+                media_grouped_list.append(InputMediaDocument(_.document.file_id))
+    return media_grouped_list
+
+
+# noinspection PyTypeChecker
+@Client.on_message(contains)
+async def filters_main_handler(client: Client, message: Message):
+    name, value = message.filter_match
+    try:
+        if value.get("MEDIA_GROUP"):
+            await payload_cache.send_media_group(
+                client,
+                ("core.filters", str(message.chat.id), name),
+                value,
+                prepare_media_group,
+                message.chat.id,
+                reply_to_message_id=message.id,
+            )
+        else:
+            await client.copy_message(
+                message.chat.id,
+                int(value["CHAT_ID"]),
+                int(value["MESSAGE_ID"]),
+                reply_to_message_id=message.id,
+            )
+    except errors.RPCError as exc:
+        # the stored message is gone
+        raise ContinuePropagation from exc
     raise ContinuePropagation
 
 
@@ -132,9 +260,14 @@ async def filter_handler(client: Client, message: Message):
     try:
         if len(message.text.split()) < 2:
             return await message.edit(
-                f"<b>Usage</b>: <code>{prefix}filter [name] (Reply required)</code>"
+                f"<b>Usage</b>: <code>{prefix}filter [-e|-w|-c] [name] "
+                "(Reply required)</code>"
             )
         name = message.text.split(maxsplit=1)[1].lower()
+        match = "exact"
+        if name.split()[0] in MATCH_MODES and len(name.split()) > 1:
+            match = MATCH_MODES[name.split()[0]]
+            name = name.split(maxsplit=1)[1]
         chat_filters = get_filters_chat(message.chat.id)
         if name in chat_filters.keys():
             return await message.edit(
@@ -174,6 +307,7 @@ async def filter_handler(client: Client, message: Message):
                 "MESSAGE_ID": str(message_id[1].id),
                 "MEDIA_GROUP": True,
                 "CHAT_ID": str(chat_id),
+                "MATCH": match,
             }
         else:
             try:
@@ -184,6 +318,7 @@ async def filter_handler(client: Client, message: Message):
                 "MEDIA_GROUP": False,
                 "MESSAGE_ID": str(message_id.id),
                 "CHAT_ID": str(chat_id),
+                "MATCH": match,
             }
 
         chat_filters.update({name: filter_})
@@ -201,9 +336,12 @@ async def filters_handler(_, message: Message):
     try:
         text = ""
         for index, a in enumerate(get_filters_chat(message.chat.id).items(), start=1):
-            key, _ = a
+            key, value = a
             key = key.replace("<", "").replace(">", "")
-            text += f"{index}. <code>{key}</code>\n"
+            text += f"{index}. <code>{key}</code>"
+            if value.get("MATCH", "exact") != "exact":
+                text += f" ({value['MATCH']})"
+            text += "\n"
         text = f"<b>Your filters in current chat</b>:\n\n" f"{text}"
         text = text[:4096]
         return await message.edit(text)
@@ -257,7 +395,9 @@ async def filter_search_handler(_, message: Message):
 
 
 modules_help["filters"] = {
-    "filter [name]": "Create filter (Reply required)",
+    "filter [-e|-w|-c] [name]": "Create filter (Reply required). It's triggered by "
+    "messages equal to the name (-e, default), containing it as a whole word (-w) "
+    "or containing it anywhere (-c)",
     "filters": "List of all triggers",
     "fdel [name]": "Delete filter by name",
     "fsearch [name]": "Info filter by name",
@@ -15,6 +15,7 @@ from pyrogram import Client, filters
 from pyrogram.types import Message
 
 from utils.misc import modules_help, prefix
+from utils.router import router
 from utils.scripts import format_module_help, with_reply
 from utils.module import ModuleManager
 
@@ -34,7 +35,10 @@ async def help_cmd(_, message: Message):
     else:
         command_name = message.command[1].lower()
         module_found = False
-        for module_name, commands in modules_help.items():
+        # look in the module the command is routed to first
+        owner = router.find(command_name)
+        modules = sorted(modules_help.items(), key=lambda item: item[0] != owner)
+        for module_name, commands in modules:
             for command in commands.keys():
                 if command.split()[0] == command_name:
                     cmd = command.split(maxsplit=1)
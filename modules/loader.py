@@ -95,10 +95,7 @@ async def loadmod(_, message: Message):
 
         os.rename(file_name, f"./modules/custom_modules/{module_name}.py")
 
-    all_modules = db.get("custom.modules", "allModules", [])
-    if module_name not in all_modules:
-        all_modules.append(module_name)
-        db.set("custom.modules", "allModules", all_modules)
+    db.sadd("custom.modules", "allModules", module_name)
     await message.edit(
         f"<b>The module <code>{module_name}</code> is loaded!\nRestarting...</b>"
     )
@@ -135,10 +132,7 @@ async def unload_mods(_, message: Message):
                 cwd=f"{BASE_PATH}/musicbot",
             )
             shutil.rmtree(f"{BASE_PATH}/musicbot")
-        all_modules = db.get("custom.modules", "allModules", [])
-        if module_name in all_modules:
-            all_modules.remove(module_name)
-            db.set("custom.modules", "allModules", all_modules)
+        db.srem("custom.modules", "allModules", module_name)
         await message.edit(
             f"<b>The module <code>{module_name}</code> removed!\nRestarting...</b>"
         )
@@ -208,7 +202,11 @@ async def unload_all_mods(_, message: Message):
     if not os.path.exists(f"{BASE_PATH}/modules/custom_modules"):
         return await message.edit("<b>You don't have any modules installed</b>")
     shutil.rmtree(f"{BASE_PATH}/modules/custom_modules")
-    db.set("custom.modules", "allModules", [])
+    db.srem(
+        "custom.modules",
+        "allModules",
+        *db.smembers("custom.modules", "allModules"),
+    )
     await message.edit("<b>Successfully unloaded all modules!\nRestarting...</b>")
 
     db.set(
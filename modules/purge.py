@@ -14,12 +14,254 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import asyncio
+import re
+from collections import OrderedDict
+
 from pyrogram import Client, filters
+from pyrogram.enums import ChatType, MessageMediaType
 from pyrogram.types import Message
 
+from utils.bulk import BulkAction
 from utils.misc import modules_help, prefix
-from utils.scripts import with_reply
+from utils.peers import peer_cache
+from utils.scripts import format_exc, with_reply
+
+# message ids of these chats are their own and have no gaps but deleted ones
+CONTIGUOUS_IDS = [ChatType.SUPERGROUP, ChatType.CHANNEL]
+BATCH_SIZE = 100
+
+
+def cache_entry(message: Message) -> tuple:
+    sender = message.from_user or message.sender_chat
+    return (
+        sender.id if sender else None,
+        message.media.value if message.media else None,
+        message.text or message.caption or "",
+    )
+
+
+class MessageCache:
+    """Sender, media type and text of recent messages of supergroups and channels
+
+    Messages are kept from the first one seen on, up to ``max_messages`` per
+    chat for the last ``max_chats`` chats, and refreshed when edited. An id
+    gap means updates were missed, so the chat is covered from there again.
+    Other chats share ids with the whole account, gaps can't be told apart
+    there and they aren't cached.
+    """
+
+    def __init__(self, max_chats: int = 50, max_messages: int = 2000):
+        self.max_chats = max_chats
+        self.max_messages = max_messages
+        # chat id -> message id -> cache entry
+        self._chats = OrderedDict()
+
+    def add(self, message: Message):
+        if message.chat.type not in CONTIGUOUS_IDS:
+            return
+        chat = self._chats.get(message.chat.id)
+        if chat is None:
+            chat = self._chats[message.chat.id] = OrderedDict()
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        elif chat and message.id > next(reversed(chat)) + 1:
+            chat.clear()
+        self._chats.move_to_end(message.chat.id)
+        chat[message.id] = cache_entry(message)
+        while len(chat) > self.max_messages:
+            chat.popitem(last=False)
+
+    def edit(self, message: Message):
+        chat = self._chats.get(message.chat.id)
+        if chat is not None and message.id in chat:
+            chat[message.id] = cache_entry(message)
+
+    def discard(self, chat_id: int, message_ids):
+        chat = self._chats.get(chat_id, {})
+        for message_id in message_ids:
+            chat.pop(message_id, None)
+
+    def covered_from(self, chat_id: int):
+        """Id from which every message of the chat is cached, or None"""
+        chat = self._chats.get(chat_id)
+        return next(iter(chat)) if chat else None
+
+    def find(self, chat_id: int, start: int, end: int, check) -> list:
+        """Ids of cached messages between start and end passing check"""
+        return [
+            message_id
+            for message_id, entry in self._chats.get(chat_id, {}).items()
+            if start <= message_id <= end and check(*entry)
+        ]
+
+
+message_cache = MessageCache()
+
+
+class PurgeFilter:
+    """Match messages by sender, media type and text"""
+
+    def __init__(self, user_id: int = None, media: str = None, pattern: str = None):
+        self.user_id = user_id
+        self.media = media
+        self.pattern = re.compile(pattern, re.IGNORECASE) if pattern else None
+
+    def __call__(self, sender_id, media, text) -> bool:
+        if self.user_id is not None and sender_id != self.user_id:
+            return False
+        if self.media is not None and media != self.media:
+            return False
+        return self.pattern is None or bool(self.pattern.search(text))
+
+
+def id_batches(start: int, end: int):
+    """Batches of ids between start and end, newest first"""
+    for last in range(end, start - 1, -BATCH_SIZE):
+        yield tuple(range(last, max(start, last - BATCH_SIZE + 1) - 1, -1))
+
+
+class Purge:
+    """Delete messages of a chat between two ids
+
+    In supergroups and channels the ids are known, so they are deleted in
+    batches without reading the history. Elsewhere, and for the part of a
+    filtered purge older than the message cache, the history is scanned.
+    Batches are deleted concurrently through BulkAction, batches that can't
+    be deleted whole are retried with only your own messages.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        message: Message,
+        start: int,
+        end: int,
+        check: PurgeFilter = None,
+    ):
+        self.client = client
+        self.chat_id = message.chat.id
+        self.contiguous = message.chat.type in CONTIGUOUS_IDS
+        self.start = start
+        self.end = end
+        self.check = check
+        self.deleted = 0
+
+    async def run(self) -> int:
+        """Delete the messages, returns how many were deleted"""
+        if self.check is None and self.contiguous:
+            failed = await self.delete(id_batches(self.start, self.end))
+        else:
+            failed = await self.delete(self.batches(self.matching_ids()))
+        if failed:
+            await self.delete(self.batches(self.own_ids(failed)))
+        return self.deleted
+
+    async def delete(self, batches) -> list:
+        """Delete batches of ids, returns the ones that failed"""
+        bulk = BulkAction(None, self.delete_batch, workers=4)
+        await bulk.run(batches)
+        return list(bulk.errors)
+
+    async def delete_batch(self, message_ids: tuple):
+        self.deleted += await self.client.delete_messages(
+            self.chat_id, list(message_ids)
+        )
+        message_cache.discard(self.chat_id, message_ids)
+
+    async def matching_ids(self):
+        end = self.end
+        if self.check is not None:
+            covered_from = message_cache.covered_from(self.chat_id)
+            if covered_from is not None and covered_from <= end:
+                for message_id in message_cache.find(
+                    self.chat_id, max(self.start, covered_from), end, self.check
+                ):
+                    yield message_id
+                end = covered_from - 1
+        if end >= self.start:
+            async for message_id in self.history_ids(end):
+                yield message_id
+
+    async def history_ids(self, end: int):
+        async for msg in self.client.get_chat_history(
+            self.chat_id, limit=end - self.start + 1, offset_id=end + 1
+        ):
+            if msg.id < self.start:
+                break
+            if self.check is None or self.check(*cache_entry(msg)):
+                yield msg.id
+
+    async def own_ids(self, batches: list):
+        for message_ids in batches:
+            for msg in await self.client.get_messages(self.chat_id, list(message_ids)):
+                if not msg.empty and msg.outgoing:
+                    yield msg.id
+
+    @staticmethod
+    async def batches(message_ids):
+        batch = []
+        async for message_id in message_ids:
+            batch.append(message_id)
+            if len(batch) >= BATCH_SIZE:
+                yield tuple(batch)
+                batch = []
+        if batch:
+            yield tuple(batch)
+
+
+PURGE_OPTIONS = ("-u", "-t", "-r")
+MEDIA_TYPES = [media.value for media in MessageMediaType]
+
+
+def parse_purge_options(args: str) -> dict:
+    """Split -u and -t with one word each and -r with the rest of the text"""
+    options = {}
+    args = args.strip()
+    while args:
+        option, *rest = args.split(maxsplit=1)
+        args = rest[0] if rest else ""
+        if option not in PURGE_OPTIONS:
+            raise ValueError(f"Unknown option {option}")
+        if option == "-r":
+            value, args = args, ""
+        else:
+            value, *rest = args.split(maxsplit=1) or [""]
+            args = rest[0] if rest else ""
+        if not value:
+            raise ValueError(f"{option} needs a value")
+        options[option] = value
+    if options.get("-t", MEDIA_TYPES[0]) not in MEDIA_TYPES:
+        raise ValueError(f"Unknown media type {options['-t']}")
+    return options
+
+
+async def parse_purge_filter(client: Client, args: str):
+    """Build a PurgeFilter from -u, -t and -r options, None without any"""
+    options = parse_purge_options(args)
+    if not options:
+        return None
+    user_id = None
+    if user := options.get("-u"):
+        if user == "me":
+            user_id = client.me.id
+        elif user.lstrip("-").isdigit():
+            user_id = int(user)
+        else:
+            user_id = (await peer_cache.get_chat(client, user)).id
+    try:
+        return PurgeFilter(user_id, options.get("-t"), options.get("-r"))
+    except re.error as e:
+        raise ValueError(f"Invalid regex: {e}") from e
+
+
+@Client.on_message(group=-1)
+async def cache_messages(_, message: Message):
+    message_cache.add(message)
+
+
+@Client.on_edited_message(group=-1)
+async def cache_edited_messages(_, message: Message):
+    message_cache.edit(message)
 
 
 @Client.on_message(filters.command("del", prefix) & filters.me)
@@ -31,24 +273,31 @@ async def del_msg(_, message: Message):
 @Client.on_message(filters.command("purge", prefix) & filters.me)
 @with_reply
 async def purge(client: Client, message: Message):
-    chunk = []
-    async for msg in client.get_chat_history(
-        chat_id=message.chat.id,
-        limit=message.id - message.reply_to_message.id + 1,
-    ):
-        if msg.id < message.reply_to_message.id:
-            break
-        chunk.append(msg.id)
-        if len(chunk) >= 100:
-            await client.delete_messages(message.chat.id, chunk)
-            chunk.clear()
-            await asyncio.sleep(1)
+    args = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else ""
+    try:
+        check = await parse_purge_filter(client, args)
+    except ValueError as e:
+        return await message.edit(
+            f"<b>{e}</b>\n<b>Usage:</b> <code>{prefix}purge [-u username/id/me] "
+            "[-t media type] [-r regex]</code>"
+        )
+    except Exception as e:
+        return await message.edit(format_exc(e))
 
-    if len(chunk) > 0:
-        await client.delete_messages(message.chat.id, chunk)
+    try:
+        handler = Purge(client, message, message.reply_to_message.id, message.id, check)
+        await handler.run()
+        if check is not None:
+            # the command itself doesn't match the filter
+            await message.delete()
+    except Exception as e:
+        await message.edit(format_exc(e))
 
 
 modules_help["purge"] = {
     "purge [reply]": "Purge (delete all messages) chat from replied message to last",
+    "purge [reply] [-u username/id/me] [-t media type] [-r regex]": "Purge only messages "
+    "from the user, with the media type (photo, video, sticker, ...) or text matching. "
+    "-r takes the rest of the text",
     "del [reply]": "Delete replied message",
 }
@@ -29,8 +29,7 @@ from pyrogram.types import Message
 
 from utils.db import db
 from utils.misc import modules_help, prefix
-
-auth_hashes = db.get("core.sessionkiller", "auths_hashes", [])
+from utils.scripts import save_authorizations
 
 
 @Client.on_message(filters.command(["sessions"], prefix) & filters.me)
@@ -78,14 +77,7 @@ async def sessionkiller(client: Client, message: Message):
     elif message.command[1] in ["enable", "on", "1", "yes", "true"]:
         db.set("core.sessionkiller", "enabled", True)
         await message.edit("<b>Sessionkiller enabled!</b>")
-        db.set(
-            "core.sessionkiller",
-            "auths_hashes",
-            [
-                auth.hash
-                for auth in (await client.invoke(GetAuthorizations())).authorizations
-            ],
-        )
+        await save_authorizations(client)
 
     elif message.command[1] in ["disable", "off", "0", "no", "false"]:
         db.set("core.sessionkiller", "enabled", False)
@@ -100,13 +92,13 @@ async def check_new_login(client: Client, update: UpdateServiceNotification, _,
         "auth"
     ):
         raise ContinuePropagation
-    if not db.get("core.sessionkiller", "enabled", False):
+    if not await db.aget("core.sessionkiller", "enabled", False):
         raise ContinuePropagation
     authorizations = (await client.invoke(GetAuthorizations()))["authorizations"]
     for auth in authorizations:
         if auth.current:
             continue
-        if auth["hash"] not in auth_hashes:
+        if not await db.asismember("core.sessionkiller", "auths_hashes", auth.hash):
             # found new unexpected login
             try:
                 await client.invoke(ResetAuthorization(hash=auth.hash))
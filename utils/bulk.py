@@ -0,0 +1,233 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pyrogram import Client
+from pyrogram.errors import FloodWait, RPCError
+from pyrogram.raw import functions
+from pyrogram.types import ChatPermissions, Message
+from pyrogram.utils import zero_datetime
+
+from utils.db import db
+from utils.peers import peer_cache
+
+
+def ban(client: Client, chat_id: int, until: timedelta = None):
+    async def action(user_id):
+        until_date = datetime.now() + until if until else zero_datetime()
+        await client.ban_chat_member(chat_id, user_id, until_date)
+
+    return action
+
+
+def unban(client: Client, chat_id: int):
+    async def action(user_id):
+        await client.unban_chat_member(chat_id, user_id)
+
+    return action
+
+
+def kick(client: Client, chat_id: int):
+    async def action(user_id):
+        await client.ban_chat_member(
+            chat_id, user_id, datetime.now() + timedelta(minutes=1)
+        )
+        await client.unban_chat_member(chat_id, user_id)
+
+    return action
+
+
+def mute(client: Client, chat_id: int, until: timedelta = None):
+    async def action(user_id):
+        until_date = datetime.now() + until if until else zero_datetime()
+        await client.restrict_chat_member(
+            chat_id, user_id, ChatPermissions(), until_date
+        )
+
+    return action
+
+
+def delete_history(client: Client, chat_id: int):
+    async def action(user_id):
+        await client.invoke(
+            functions.channels.DeleteParticipantHistory(
+                channel=await peer_cache.resolve_peer(client, chat_id),
+                participant=await peer_cache.resolve_peer(client, user_id),
+            )
+        )
+
+    return action
+
+
+class BulkAction:
+    """Run an action for many targets
+
+    Up to ``workers`` calls run at once. A FloodWait pauses every worker for
+    the requested time and halves the concurrency, which grows back by one
+    after a run of successes. Any other error fails only its target and is
+    kept in ``errors``. Targets that succeeded are saved to a set in
+    ``core.bulk`` so running the same ``name`` again skips them, the set is
+    removed once a run completes, without a name nothing is saved. Progress
+    is edited into ``message`` at most every ``progress_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        name: Optional[str],
+        action,
+        message: Message = None,
+        title: str = "Working",
+        workers: int = 8,
+        progress_interval: float = 5,
+        checkpoint_size: int = 50,
+    ):
+        self.name = name
+        self.action = action
+        self.message = message
+        self.title = title
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.checkpoint_size = checkpoint_size
+
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.errors = {}
+        self._limit = workers
+        self._active = 0
+        self._successes = 0
+        self._paused_until = 0
+        self._cond = asyncio.Condition()
+        # targets that succeeded in this run, and the ones not saved yet
+        self._handled = set()
+        self._finished = []
+        self._last_progress = 0
+
+    async def run(self, targets) -> dict:
+        """Run the action for every target, an iterable or async iterable"""
+        finished = await db.asmembers("core.bulk", self.name) if self.name else set()
+        queue = asyncio.Queue(self.workers * 2)
+        workers = [
+            asyncio.create_task(self._worker(queue)) for _ in range(self.workers)
+        ]
+        try:
+            if hasattr(targets, "__aiter__"):
+                async for target in targets:
+                    await self._put(queue, target, finished)
+            else:
+                for target in targets:
+                    await self._put(queue, target, finished)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except BaseException:
+            for worker in workers:
+                worker.cancel()
+            await self._checkpoint()
+            raise
+
+        # nothing left to resume
+        await self._checkpoint()
+        if self.name and (finished or self._handled):
+            await db.asrem("core.bulk", self.name, *finished, *self._handled)
+        await self._progress(force=True)
+        return {"done": self.done, "failed": self.failed, "skipped": self.skipped}
+
+    async def _put(self, queue: asyncio.Queue, target, finished: set):
+        if target in finished:
+            self.skipped += 1
+            return
+        await queue.put(target)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while (target := await queue.get()) is not None:
+            try:
+                await self._call(target)
+            except Exception as e:
+                # a failed target is retried by the next run with the same name
+                self.failed += 1
+                self.errors[target] = e
+            else:
+                self.done += 1
+                self._handled.add(target)
+                self._finished.append(target)
+                if len(self._finished) >= self.checkpoint_size:
+                    await self._checkpoint()
+            await self._progress()
+
+    async def _call(self, target):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._active < self._limit)
+                self._active += 1
+            try:
+                if (pause := self._paused_until - time.monotonic()) > 0:
+                    await asyncio.sleep(pause)
+                await self.action(target)
+            except FloodWait as e:
+                self._flood_wait(e.value)
+                continue
+            finally:
+                async with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+            self._success()
+            return
+
+    def _flood_wait(self, seconds: int):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._limit = max(1, self._limit // 2)
+        self._successes = 0
+        logging.info(
+            "%s: FloodWait for %ss, %s workers now", self.name, seconds, self._limit
+        )
+
+    def _success(self):
+        self._successes += 1
+        if self._limit < self.workers and self._successes >= self._limit * 10:
+            self._limit += 1
+            self._successes = 0
+
+    async def _checkpoint(self):
+        finished, self._finished = self._finished, []
+        if finished and self.name:
+            await db.asadd("core.bulk", self.name, *finished)
+
+    async def _progress(self, force=False):
+        if self.message is None:
+            return
+        if (
+            not force
+            and time.monotonic() - self._last_progress < self.progress_interval
+        ):
+            return
+        self._last_progress = time.monotonic()
+        text = (
+            f"<b>{self.title}...</b>\n"
+            f"<b>Done:</b> <code>{self.done}</code>\n"
+            f"<b>Failed:</b> <code>{self.failed}</code>"
+        )
+        if self.skipped:
+            text += f"\n<b>Already done before:</b> <code>{self.skipped}</code>"
+        try:
+            await self.message.edit(text)
+        except RPCError:
+            pass
@@ -17,6 +17,34 @@ second_session = os.getenv("SECOND_SESSION", env.str("SECOND_SESSION", ""))
 db_type = os.getenv("DATABASE_TYPE", env.str("DATABASE_TYPE"))
 db_url = os.getenv("DATABASE_URL", env.str("DATABASE_URL", ""))
 db_name = os.getenv("DATABASE_NAME", env.str("DATABASE_NAME"))
+db_mongo_layout = os.getenv(
+    "DB_MONGO_LAYOUT", env.str("DB_MONGO_LAYOUT", "collections")
+)
+db_cache_size = int(os.getenv("DB_CACHE_SIZE", env.int("DB_CACHE_SIZE", 1024)))
+db_cache_bytes = int(
+    os.getenv("DB_CACHE_BYTES", env.int("DB_CACHE_BYTES", 8 * 1024 * 1024))
+)
+db_batch_interval = float(
+    os.getenv("DB_BATCH_INTERVAL", env.float("DB_BATCH_INTERVAL", 0))
+)
+db_batch_size = int(os.getenv("DB_BATCH_SIZE", env.int("DB_BATCH_SIZE", 100)))
+db_readers = int(os.getenv("DB_READERS", env.int("DB_READERS", 4)))
+db_codec = os.getenv("DB_CODEC", env.str("DB_CODEC", "json"))
+db_compress_threshold = int(
+    os.getenv("DB_COMPRESS_THRESHOLD", env.int("DB_COMPRESS_THRESHOLD", 0))
+)
+db_maintenance_interval = float(
+    os.getenv("DB_MAINTENANCE_INTERVAL", env.float("DB_MAINTENANCE_INTERVAL", 24))
+)
+db_backup_path = os.getenv("DB_BACKUP_PATH", env.str("DB_BACKUP_PATH", ""))
+# env.bool, the variable is a string like "False" once .env is loaded
+db_change_streams = env.bool("DB_CHANGE_STREAMS", False)
+chat_history_limit = int(
+    os.getenv("CHAT_HISTORY_LIMIT", env.int("CHAT_HISTORY_LIMIT", 0))
+)
+chat_history_tokens = int(
+    os.getenv("CHAT_HISTORY_TOKENS", env.int("CHAT_HISTORY_TOKENS", 0))
+)
 
 apiflash_key = os.getenv("APIFLASH_KEY", env.str("APIFLASH_KEY"))
 rmbg_key = os.getenv("RMBG_KEY", env.str("RMBG_KEY", ""))
@@ -14,19 +14,111 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import re
+import sys
 import json
+import time
+import heapq
+import asyncio
+import inspect
+import logging
+import functools
+import queue
 import threading
 import sqlite3
+import zlib
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dns import resolver
 import pymongo
 from utils import config
 
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    # pymongo < 4.9, fall back to running the sync client in threads
+    AsyncMongoClient = None
+
+try:
+    import msgpack
+except ImportError:
+    # only needed for DB_CODEC=msgpack
+    msgpack = None
+
 resolver.default_resolver = resolver.Resolver(configure=False)
 resolver.default_resolver.nameservers = ["1.1.1.1"]
 
 
-class Database:
+class AsyncDatabase:
+    async def aget(self, module: str, variable: str, default=None):
+        """Get value from database without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aset(self, module: str, variable: str, value):
+        """Set key in database without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aremove(self, module: str, variable: str):
+        """Remove key from database without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aget_collection(self, module: str) -> dict:
+        """Get database for selected module without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aget_many(self, module: str, variables, default=None) -> dict:
+        """Get several values without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aset_many(self, module: str, values: dict):
+        """Set several keys without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aremove_many(self, module: str, variables):
+        """Remove several keys without blocking the event loop"""
+        raise NotImplementedError
+
+    async def asadd(self, module: str, variable: str, *members):
+        """Add members to a set without blocking the event loop"""
+        raise NotImplementedError
+
+    async def asrem(self, module: str, variable: str, *members):
+        """Remove members from a set without blocking the event loop"""
+        raise NotImplementedError
+
+    async def asismember(self, module: str, variable: str, member) -> bool:
+        """Check set membership without blocking the event loop"""
+        raise NotImplementedError
+
+    async def asmembers(self, module: str, variable: str) -> set:
+        """Get all members of a set without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aadd_chat_history(self, user_id, message):
+        """Append to AI chat history without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aget_chat_history(self, user_id, default=None, limit=None) -> list:
+        """Get AI chat history without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aclear_chat_history(self, *user_ids):
+        """Delete AI chat histories without blocking the event loop"""
+        raise NotImplementedError
+
+    async def aclose(self):
+        """Close the database without blocking the event loop"""
+        raise NotImplementedError
+
+
+class Database(AsyncDatabase):
+    # executor used by the default async implementations, None means
+    # the event loop's default one
+    _executor = None
+
     def get(self, module: str, variable: str, default=None):
         """Get value from database"""
         raise NotImplementedError
@@ -43,74 +135,838 @@ class Database:
         """Get database for selected module"""
         raise NotImplementedError
 
+    def get_many(self, module: str, variables, default=None) -> dict:
+        """Get several values of a module at once"""
+        return {var: self.get(module, var, default) for var in variables}
+
+    def set_many(self, module: str, values: dict):
+        """Set several keys of a module at once"""
+        for var, value in values.items():
+            self.set(module, var, value)
+
+    def remove_many(self, module: str, variables):
+        """Remove several keys of a module at once"""
+        for var in variables:
+            self.remove(module, var)
+
+    def sadd(self, module: str, variable: str, *members):
+        """Add members to a set"""
+        raise NotImplementedError
+
+    def srem(self, module: str, variable: str, *members):
+        """Remove members from a set"""
+        raise NotImplementedError
+
+    def sismember(self, module: str, variable: str, member) -> bool:
+        """Check if member is in a set"""
+        raise NotImplementedError
+
+    def smembers(self, module: str, variable: str) -> set:
+        """Get all members of a set"""
+        raise NotImplementedError
+
+    def list_to_set(self, module: str, variable: str):
+        """Move a value stored as a JSON list into set storage"""
+        members = self.get(module, variable)
+        if isinstance(members, list):
+            if members:
+                self.sadd(module, variable, *members)
+            self.remove(module, variable)
+
     def close(self):
         """Close the database"""
         raise NotImplementedError
 
+    async def aclose(self):
+        # not through _run, closing may shut its executor down
+        await asyncio.to_thread(self.close)
+
+    @contextmanager
+    def transaction(self):
+        """Apply several writes at once, where the backend supports it"""
+        yield self
+
+    def flush(self):
+        """Persist buffered writes, if the backend buffers any"""
+
+    def invalidate(self, module: str = None, variable: str = None):
+        """Forget cached values, if any layer caches them"""
+
+    def subscribe(self, module: str, callback):
+        """Call ``callback(module, variable, value)`` when a key of module changes"""
+        raise NotImplementedError
+
+    def follow(self, source: "MongoDatabase", loop: asyncio.AbstractEventLoop):
+        """Publish changes other instances make to ``source`` on ``loop``"""
+        raise NotImplementedError
+
+    def migrate_codec(self, batch_size: int = 500) -> int:
+        """Re-encode stored values in the configured format, if the backend has one"""
+        return 0
+
+    def maintain(self, backup_path: str = None, full: bool = False) -> dict:
+        """Compact the database and back it up, returns metrics of the run
+
+        ``full`` also allows one-time work that blocks writes for a while.
+        Backends that don't need maintenance return an empty dict.
+        """
+        return {}
+
+    async def run_maintenance(self, interval: float, backup_path: str = None):
+        """Run maintain() every interval seconds, forever"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                metrics = await self._run(self.maintain, backup_path)
+            except Exception:
+                logging.exception("Database maintenance failed")
+                continue
+            if metrics:
+                logging.info("Database maintenance done: %s", metrics)
+                self.set("core.database", "maintenance", metrics)
+
+    def get_modules(self) -> list:
+        """Get names of all modules"""
+        raise NotImplementedError
+
+    def iter_collection(self, module: str, batch_size: int = 500, after: str = None):
+        """Yield (variable, value) of a module ordered by variable
+
+        Values are fetched batch_size at a time, starting after ``after``.
+        """
+        for var, value in sorted(self.get_collection(module).items()):
+            if after is None or var > after:
+                yield var, value
+
+    def iter_sets(self, after: tuple = None):
+        """Yield (module, variable, members) of every set
+
+        Sets come ordered by module and variable, starting after the
+        (module, variable) pair ``after``.
+        """
+        raise NotImplementedError
+
+    def iter_chat_histories(self, after: int = None):
+        """Yield (user_id, messages) of every AI chat history
+
+        Histories come ordered by user id, starting after ``after``.
+        """
+        raise NotImplementedError
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args)
+        )
+
+    async def aget(self, module: str, variable: str, default=None):
+        return await self._run(self.get, module, variable, default)
+
+    async def aset(self, module: str, variable: str, value):
+        return await self._run(self.set, module, variable, value)
+
+    async def aremove(self, module: str, variable: str):
+        return await self._run(self.remove, module, variable)
+
+    async def aget_collection(self, module: str) -> dict:
+        return await self._run(self.get_collection, module)
+
+    async def aget_many(self, module: str, variables, default=None) -> dict:
+        return await self._run(self.get_many, module, list(variables), default)
+
+    async def aset_many(self, module: str, values: dict):
+        return await self._run(self.set_many, module, values)
+
+    async def aremove_many(self, module: str, variables):
+        return await self._run(self.remove_many, module, list(variables))
+
+    async def asadd(self, module: str, variable: str, *members):
+        return await self._run(self.sadd, module, variable, *members)
+
+    async def asrem(self, module: str, variable: str, *members):
+        return await self._run(self.srem, module, variable, *members)
+
+    async def asismember(self, module: str, variable: str, member) -> bool:
+        return await self._run(self.sismember, module, variable, member)
+
+    async def asmembers(self, module: str, variable: str) -> set:
+        return await self._run(self.smembers, module, variable)
+
+    async def aadd_chat_history(self, user_id, message):
+        return await self._run(self.add_chat_history, user_id, message)
+
+    async def aget_chat_history(self, user_id, default=None, limit=None) -> list:
+        return await self._run(self.get_chat_history, user_id, default, limit)
+
+    async def aclear_chat_history(self, *user_ids):
+        return await self._run(self.clear_chat_history, *user_ids)
+
+    # AI chat history is stored one row per message, so appending costs the
+    # same however long the conversation is. Histories are trimmed to the
+    # last CHAT_HISTORY_LIMIT messages and CHAT_HISTORY_TOKENS tokens.
+
+    def _append_chat_history(self, user_id, messages, limit=0, max_tokens=0):
+        """Append messages to a history and trim it"""
+        raise NotImplementedError
+
+    def _read_chat_history(self, user_id, limit=None) -> list:
+        """Read the last messages of a history, oldest first"""
+        raise NotImplementedError
+
+    def _delete_chat_history(self, user_ids):
+        """Delete whole histories"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _count_tokens(message) -> int:
+        # rough estimate, about four characters per token
+        return len(json.dumps(message, default=str)) // 4 + 1
+
+    def _legacy_chat_history(self, user_id) -> list:
+        # histories used to be a single JSON list, moved out on first use
+        if user_id in self._history_migrated:
+            return []
+        self._history_migrated.add(user_id)
+        module = f"core.cohere.user_{user_id}"
+        chat_history = self.get(module, "chat_history")
+        if chat_history is None:
+            return []
+        self.remove(module, "chat_history")
+        return chat_history
+
+    def add_chat_history(self, user_id, message):
+        self._append_chat_history(
+            user_id,
+            self._legacy_chat_history(user_id) + [message],
+            config.chat_history_limit,
+            config.chat_history_tokens,
+        )
+
+    def get_chat_history(self, user_id, default=None, limit=None) -> list:
+        legacy = self._legacy_chat_history(user_id)
+        if legacy:
+            self._append_chat_history(
+                user_id, legacy, config.chat_history_limit, config.chat_history_tokens
+            )
+        chat_history = self._read_chat_history(user_id, limit)
+        if not chat_history and default is not None:
+            return default
+        return chat_history
+
+    def clear_chat_history(self, *user_ids):
+        for user_id in user_ids:
+            self._legacy_chat_history(user_id)
+        if user_ids:
+            self._delete_chat_history(user_ids)
+
+    def addaiuser(self, user_id):
+        self.sadd("core.chatbot", "chatai_users", user_id)
+
+    def remaiuser(self, user_id):
+        self.srem("core.chatbot", "chatai_users", user_id)
+
+    def getaiusers(self):
+        return list(self.smembers("core.chatbot", "chatai_users"))
+
 
 class MongoDatabase(Database):
-    def __init__(self, url, name):
+    # collection holding every module in the "single" layout
+    KV_COLLECTION = "_kv"
+    SETS_COLLECTION = "_sets"
+    HISTORY_COLLECTION = "_chat_history"
+
+    def __init__(self, url, name, layout="collections"):
+        self._url = url
+        self._name = name
         self._client = pymongo.MongoClient(url)
         self._database = self._client[name]
+        self._aclient = None
+        self._single = layout == "single"
+        self._indexed = set()
+        # marks documents written by this instance in change streams
+        self.origin = uuid.uuid4().hex
+
+        self._database[self.SETS_COLLECTION].create_index(
+            [("module", pymongo.ASCENDING), ("var", pymongo.ASCENDING)],
+            unique=True,
+        )
+        self._database[self.HISTORY_COLLECTION].create_index(
+            [("user_id", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)]
+        )
+        self._history_migrated = set()
+
+        if self._single:
+            self._database[self.KV_COLLECTION].create_index(
+                [("module", pymongo.ASCENDING), ("var", pymongo.ASCENDING)],
+                unique=True,
+            )
+            self.migrate_layout()
+
+    @property
+    def _adatabase(self):
+        # created lazily so it binds to the loop the bot actually runs on
+        if self._aclient is None:
+            self._aclient = AsyncMongoClient(self._url)
+        return self._aclient[self._name]
+
+    def _legacy_collections(self) -> list:
+        return [
+            name
+            for name in self._database.list_collection_names()
+            if re.match(r"^(core|custom)", name)
+        ]
+
+    def migrate_layout(self, batch_size: int = 1000) -> int:
+        """Move collection-per-module data into the single indexed collection"""
+        kv = self._database[self.KV_COLLECTION]
+        moved = 0
+        for module in self._legacy_collections():
+            ops = []
+            for doc in self._database[module].find({}, {"_id": 0}):
+                ops.append(
+                    pymongo.ReplaceOne(
+                        {"module": module, "var": doc["var"]},
+                        {"module": module, "var": doc["var"], "val": doc["val"]},
+                        upsert=True,
+                    )
+                )
+                if len(ops) >= batch_size:
+                    kv.bulk_write(ops, ordered=False)
+                    moved += len(ops)
+                    ops.clear()
+            if ops:
+                kv.bulk_write(ops, ordered=False)
+                moved += len(ops)
+            self._database.drop_collection(module)
+        return moved
+
+    def _collection(self, module: str):
+        if self._single:
+            return self._database[self.KV_COLLECTION]
+        if module not in self._indexed:
+            self._database[module].create_index("var")
+            self._indexed.add(module)
+        return self._database[module]
+
+    async def _acollection(self, module: str):
+        # same as _collection, the index is created through the async client
+        if self._single:
+            return self._adatabase[self.KV_COLLECTION]
+        if module not in self._indexed:
+            await self._adatabase[module].create_index("var")
+            self._indexed.add(module)
+        return self._adatabase[module]
+
+    def _key(self, module: str, variable):
+        if self._single:
+            return {"module": module, "var": variable}
+        return {"var": variable}
+
+    def _scope(self, module: str) -> dict:
+        return {"module": module} if self._single else {}
+
+    def _replace_ops(self, module: str, values: dict) -> list:
+        return [
+            pymongo.ReplaceOne(
+                self._key(module, var),
+                {**self._key(module, var), "val": val, "origin": self.origin},
+                upsert=True,
+            )
+            for var, val in values.items()
+        ]
 
     def set(self, module: str, variable: str, value):
         if not isinstance(module, str) or not isinstance(variable, str):
             raise ValueError("Module and variable must be strings")
-        self._database[module].replace_one(
-            {"var": variable}, {"var": variable, "val": value}, upsert=True
+        key = self._key(module, variable)
+        self._collection(module).replace_one(
+            key, {**key, "val": value, "origin": self.origin}, upsert=True
         )
 
     def get(self, module: str, variable: str, default=None):
         if not isinstance(module, str) or not isinstance(variable, str):
             raise ValueError("Module and variable must be strings")
-        doc = self._database[module].find_one({"var": variable})
+        doc = self._collection(module).find_one(
+            self._key(module, variable)
+        )
         return default if doc is None else doc["val"]
 
     def get_collection(self, module: str):
         if not isinstance(module, str):
             raise ValueError("Module must be a string")
-        return {item["var"]: item["val"] for item in self._database[module].find()}
+        return {
+            item["var"]: item["val"]
+            for item in self._collection(module).find(
+                self._scope(module)
+            )
+        }
 
     def remove(self, module: str, variable: str):
         if not isinstance(module, str) or not isinstance(variable, str):
             raise ValueError("Module and variable must be strings")
-        self._database[module].delete_one({"var": variable})
+        self._collection(module).delete_one(
+            self._key(module, variable)
+        )
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        result = dict.fromkeys(variables, default)
+        query = self._key(module, {"$in": list(result)})
+        for doc in self._collection(module).find(query):
+            result[doc["var"]] = doc["val"]
+        return result
+
+    def set_many(self, module: str, values: dict):
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        if values:
+            self._collection(module).bulk_write(
+                self._replace_ops(module, values), ordered=False
+            )
+
+    def remove_many(self, module: str, variables):
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        self._collection(module).delete_many(
+            self._key(module, {"$in": list(variables)})
+        )
+
+    def sadd(self, module: str, variable: str, *members):
+        if members:
+            self._database[self.SETS_COLLECTION].update_one(
+                {"module": module, "var": variable},
+                {
+                    "$addToSet": {"members": {"$each": list(members)}},
+                    "$set": {"origin": self.origin},
+                },
+                upsert=True,
+            )
+
+    def srem(self, module: str, variable: str, *members):
+        if members:
+            self._database[self.SETS_COLLECTION].update_one(
+                {"module": module, "var": variable},
+                {
+                    "$pull": {"members": {"$in": list(members)}},
+                    "$set": {"origin": self.origin},
+                },
+            )
+
+    def sismember(self, module: str, variable: str, member) -> bool:
+        doc = self._database[self.SETS_COLLECTION].find_one(
+            {"module": module, "var": variable, "members": member}, {"_id": 1}
+        )
+        return doc is not None
+
+    def smembers(self, module: str, variable: str) -> set:
+        doc = self._database[self.SETS_COLLECTION].find_one(
+            {"module": module, "var": variable}
+        )
+        return set(doc["members"]) if doc else set()
+
+    def _append_chat_history(self, user_id, messages, limit=0, max_tokens=0):
+        history = self._database[self.HISTORY_COLLECTION]
+        history.insert_many(
+            [
+                {
+                    "user_id": user_id,
+                    "message": message,
+                    "tokens": self._count_tokens(message),
+                }
+                for message in messages
+            ],
+            ordered=True,
+        )
+
+        if not limit and not max_tokens:
+            return
+        total = 0
+        newest = history.find({"user_id": user_id}, {"tokens": 1}).sort("_id", -1)
+        for num, doc in enumerate(newest):
+            total += doc["tokens"]
+            # the newest message is always kept, even if it's over budget
+            if limit and num >= limit or max_tokens and num and total > max_tokens:
+                history.delete_many({"user_id": user_id, "_id": {"$lte": doc["_id"]}})
+                break
+
+    def _read_chat_history(self, user_id, limit=None) -> list:
+        cursor = (
+            self._database[self.HISTORY_COLLECTION]
+            .find({"user_id": user_id}, {"message": 1})
+            .sort("_id", -1)
+        )
+        if limit:
+            cursor = cursor.limit(limit)
+        return [doc["message"] for doc in cursor][::-1]
+
+    def _delete_chat_history(self, user_ids):
+        self._database[self.HISTORY_COLLECTION].delete_many(
+            {"user_id": {"$in": list(user_ids)}}
+        )
+
+    def get_modules(self) -> list:
+        if self._single:
+            return sorted(self._database[self.KV_COLLECTION].distinct("module"))
+        return sorted(self._legacy_collections())
+
+    def iter_collection(self, module: str, batch_size: int = 500, after: str = None):
+        query = self._scope(module)
+        if after is not None:
+            query["var"] = {"$gt": after}
+        cursor = (
+            self._collection(module)
+            .find(query, {"_id": 0, "var": 1, "val": 1})
+            .sort("var", pymongo.ASCENDING)
+            .batch_size(batch_size)
+        )
+        for doc in cursor:
+            yield doc["var"], doc["val"]
+
+    def iter_sets(self, after: tuple = None):
+        query = {}
+        if after is not None:
+            module, var = after
+            query = {
+                "$or": [
+                    {"module": {"$gt": module}},
+                    {"module": module, "var": {"$gt": var}},
+                ]
+            }
+        cursor = (
+            self._database[self.SETS_COLLECTION]
+            .find(query, {"_id": 0})
+            .sort([("module", pymongo.ASCENDING), ("var", pymongo.ASCENDING)])
+        )
+        for doc in cursor:
+            yield doc["module"], doc["var"], set(doc.get("members", ()))
+
+    def iter_chat_histories(self, after: int = None):
+        user_ids = sorted(self._database[self.HISTORY_COLLECTION].distinct("user_id"))
+        for user_id in user_ids:
+            if after is None or user_id > after:
+                yield user_id, self._read_chat_history(user_id)
+
+    def watch(self, callback):
+        """Call ``callback(module, variable)`` for changes made by any client
+
+        Blocks, so run it in a thread. Change streams need a replica set.
+        ``variable`` is None when only the module is known (deletions),
+        ``module`` too when even that isn't (deletions in "single" layout).
+        Writes of this instance are skipped, except deletions, which carry
+        no document to tell where they came from.
+        """
+        operations = ["insert", "update", "replace", "delete"]
+        pipeline = [{"$match": {"operationType": {"$in": operations}}}]
+        resume_token = None
+        while True:
+            try:
+                with self._database.watch(
+                    pipeline, full_document="updateLookup", resume_after=resume_token
+                ) as stream:
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self._dispatch_change(change, callback)
+            except pymongo.errors.OperationFailure as e:
+                logging.error("Can't follow database changes: %s", e)
+                return
+            except pymongo.errors.PyMongoError:
+                logging.exception("Database change stream failed, reconnecting")
+                time.sleep(5)
+
+    def _dispatch_change(self, change: dict, callback):
+        collection = change["ns"]["coll"]
+        doc = change.get("fullDocument")
+        if doc is not None and doc.get("origin") == self.origin:
+            return
+        if collection in (self.SETS_COLLECTION, self.KV_COLLECTION):
+            if collection == self.KV_COLLECTION and not self._single:
+                return
+            if doc is None:
+                callback(None, None)
+            else:
+                callback(doc["module"], doc["var"])
+        elif not self._single and re.match(r"^(core|custom)", collection):
+            callback(collection, doc["var"] if doc else None)
 
     def close(self):
+        """Close the sync client, aclose() closes the async one too"""
         self._client.close()
 
-    def add_chat_history(self, user_id, message):
-        chat_history = self.get_chat_history(user_id, default=[])
-        chat_history.append(message)
-        self.set(f"core.cohere.user_{user_id}", "chat_history", chat_history)
+    async def aclose(self):
+        if self._aclient is not None:
+            await self._aclient.close()
+            self._aclient = None
+        await super().aclose()
 
-    def get_chat_history(self, user_id, default=None):
-        if default is None:
-            default = []
-        return self.get(f"core.cohere.user_{user_id}", "chat_history", default=[])
+    async def aset(self, module: str, variable: str, value):
+        if AsyncMongoClient is None:
+            return await super().aset(module, variable, value)
+        if not isinstance(module, str) or not isinstance(variable, str):
+            raise ValueError("Module and variable must be strings")
+        key = self._key(module, variable)
+        collection = await self._acollection(module)
+        await collection.replace_one(
+            key, {**key, "val": value, "origin": self.origin}, upsert=True
+        )
 
-    def addaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id not in chatai_users:
-            chatai_users.append(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+    async def aget(self, module: str, variable: str, default=None):
+        if AsyncMongoClient is None:
+            return await super().aget(module, variable, default)
+        if not isinstance(module, str) or not isinstance(variable, str):
+            raise ValueError("Module and variable must be strings")
+        collection = await self._acollection(module)
+        doc = await collection.find_one(self._key(module, variable))
+        return default if doc is None else doc["val"]
 
-    def remaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id in chatai_users:
-            chatai_users.remove(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+    async def aget_collection(self, module: str):
+        if AsyncMongoClient is None:
+            return await super().aget_collection(module)
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        collection = await self._acollection(module)
+        return {
+            item["var"]: item["val"]
+            async for item in collection.find(self._scope(module))
+        }
+
+    async def aremove(self, module: str, variable: str):
+        if AsyncMongoClient is None:
+            return await super().aremove(module, variable)
+        if not isinstance(module, str) or not isinstance(variable, str):
+            raise ValueError("Module and variable must be strings")
+        collection = await self._acollection(module)
+        await collection.delete_one(self._key(module, variable))
+
+    async def aget_many(self, module: str, variables, default=None) -> dict:
+        if AsyncMongoClient is None:
+            return await super().aget_many(module, variables, default)
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        result = dict.fromkeys(variables, default)
+        query = self._key(module, {"$in": list(result)})
+        collection = await self._acollection(module)
+        async for doc in collection.find(query):
+            result[doc["var"]] = doc["val"]
+        return result
+
+    async def aset_many(self, module: str, values: dict):
+        if AsyncMongoClient is None:
+            return await super().aset_many(module, values)
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        if values:
+            collection = await self._acollection(module)
+            await collection.bulk_write(
+                self._replace_ops(module, values), ordered=False
+            )
+
+    async def aremove_many(self, module: str, variables):
+        if AsyncMongoClient is None:
+            return await super().aremove_many(module, variables)
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        collection = await self._acollection(module)
+        await collection.delete_many(self._key(module, {"$in": list(variables)}))
+
+    async def asadd(self, module: str, variable: str, *members):
+        if AsyncMongoClient is None:
+            return await super().asadd(module, variable, *members)
+        if members:
+            await self._adatabase[self.SETS_COLLECTION].update_one(
+                {"module": module, "var": variable},
+                {
+                    "$addToSet": {"members": {"$each": list(members)}},
+                    "$set": {"origin": self.origin},
+                },
+                upsert=True,
+            )
+
+    async def asrem(self, module: str, variable: str, *members):
+        if AsyncMongoClient is None:
+            return await super().asrem(module, variable, *members)
+        if members:
+            await self._adatabase[self.SETS_COLLECTION].update_one(
+                {"module": module, "var": variable},
+                {
+                    "$pull": {"members": {"$in": list(members)}},
+                    "$set": {"origin": self.origin},
+                },
+            )
+
+    async def asismember(self, module: str, variable: str, member) -> bool:
+        if AsyncMongoClient is None:
+            return await super().asismember(module, variable, member)
+        doc = await self._adatabase[self.SETS_COLLECTION].find_one(
+            {"module": module, "var": variable, "members": member}, {"_id": 1}
+        )
+        return doc is not None
+
+    async def asmembers(self, module: str, variable: str) -> set:
+        if AsyncMongoClient is None:
+            return await super().asmembers(module, variable)
+        doc = await self._adatabase[self.SETS_COLLECTION].find_one(
+            {"module": module, "var": variable}
+        )
+        return set(doc["members"]) if doc else set()
+
+
+class JsonCodec:
+    """Values as JSON text, the format SQLite databases were created with"""
+
+    name = "json"
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    """Values as MessagePack, smaller and faster to parse than JSON"""
+
+    name = "msgpack"
+
+    @staticmethod
+    def dumps(value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
 
-    def getaiusers(self):
-        return self.get("core.chatbot", "chatai_users", default=[])
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec)}
 
 
 class SqliteDatabase(Database):
-    def __init__(self, file):
-        self._conn = sqlite3.connect(file, check_same_thread=False)
-        self._conn.row_factory = sqlite3.Row
+    def __init__(
+        self,
+        file,
+        batch_interval: float = 0,
+        batch_size: int = 100,
+        codec: str = "json",
+        compress_threshold: int = 0,
+        readers: int = 4,
+    ):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown database codec: {codec}")
+        if codec == "msgpack" and msgpack is None:
+            raise RuntimeError("The msgpack codec needs the msgpack package")
+
+        self._file = file
+        self._conn = self._connect(file)
         self._cursor = self._conn.cursor()
-        self._lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._statements = {}
+        # only takes effect on a new database, maintain(full=True) converts old ones
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+        # in WAL mode readers don't block the writer or each other, so reads
+        # get their own connections. An in-memory database can't be shared
+        self._readers = None
+        if readers and file != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._readers = queue.SimpleQueue()
+            for _ in range(readers):
+                reader = self._connect(file)
+                reader.execute("PRAGMA query_only=1")
+                self._readers.put(reader)
+        else:
+            readers = 0
+        # one worker for writes, they are serialized by the lock anyway
+        self._executor = ThreadPoolExecutor(1 + readers, thread_name_prefix="sqlite")
+
+        # group commit: with a non-zero interval, writes are committed
+        # together once batch_size of them are pending or the interval ends
+        self._batch_interval = batch_interval
+        self._batch_size = batch_size
+        self._pending = 0
+        self._flush_timer = None
+        self._tx_depth = 0
+        if batch_interval:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        # members are stored JSON encoded so ints and strings stay apart
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS _sets (
+            module TEXT NOT NULL,
+            var TEXT NOT NULL,
+            member TEXT NOT NULL,
+            PRIMARY KEY (module, var, member)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS _chat_history (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            tokens INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS _chat_history_user "
+            "ON _chat_history (user_id, id)"
+        )
+        self._conn.commit()
+        self._history_migrated = set()
+        self._load_tables()
+
+        # lists and dicts are encoded with the codec and zlib compressed from
+        # compress_threshold bytes on, the type column records how. Rows in
+        # any format stay readable, migrate_codec converts them
+        self._codec = CODECS[codec]
+        self._compress_threshold = compress_threshold
+
+    @staticmethod
+    def _connect(file) -> sqlite3.Connection:
+        conn = sqlite3.connect(file, check_same_thread=False, cached_statements=512)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _sql(self, module: str) -> dict:
+        # statements are built once per module, so sqlite3's statement cache
+        # keeps them prepared
+        statements = self._statements.get(module)
+        if statements is None:
+            if not re.match(r"^(core|custom)", module):
+                raise ValueError(f"Invalid module name format: {module}")
+            statements = self._statements[module] = {
+                "get": f"SELECT * FROM '{module}' WHERE var=?",
+                "all": f"SELECT * FROM '{module}'",
+                "set": f"""
+                INSERT INTO '{module}' VALUES ( ?, ?, ? )
+                ON CONFLICT (var) DO
+                UPDATE SET val=excluded.val, type=excluded.type
+                """,
+                "remove": f"DELETE FROM '{module}' WHERE var=?",
+            }
+        return statements
+
+    def _read(self, module, sql: str, params=()) -> list:
+        """Run a query on a reader connection
+
+        While the writer has uncommitted changes the query runs on it instead,
+        so reads always see earlier writes.
+        """
+        if module is not None and module not in self._tables:
+            # nothing was ever written to this module
+            return []
+        if self._readers is None or self._conn.in_transaction:
+            return self._query(sql, params).fetchall()
+        conn = self._readers.get()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            self._readers.put(conn)
 
     @staticmethod
     def _parse_row(row: sqlite3.Row):
@@ -120,118 +976,1152 @@ class SqliteDatabase(Database):
             return int(row["val"])
         if row["type"] == "str":
             return row["val"]
-        return json.loads(row["val"])
+        codec, _, compressed = row["type"].partition(".")
+        data = row["val"]
+        if compressed:
+            data = zlib.decompress(data)
+        return CODECS[codec].loads(data)
 
-    def _execute(self, module: str, *args, **kwargs) -> sqlite3.Cursor:
-        pattern = r"^(core|custom)"
-        if not re.match(pattern, module):
-            raise ValueError(f"Invalid module name format: {module}")
+    @staticmethod
+    def _create_sql(table: str) -> str:
+        return f"""
+        CREATE TABLE IF NOT EXISTS '{table}' (
+        var TEXT PRIMARY KEY NOT NULL,
+        val TEXT NOT NULL,
+        type TEXT NOT NULL
+        ) WITHOUT ROWID
+        """
 
-        self._lock.acquire()
-        try:
+    def _load_tables(self):
+        rows = self._conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type='table'"
+        ).fetchall()
+        self._tables = {row["name"] for row in rows}
+
+        # tables used to be rowid tables with a UNIQUE var, which looks values
+        # up through a separate index
+        old = [
+            row["name"]
+            for row in rows
+            if re.match(r"^(core|custom)", row["name"])
+            and "WITHOUT ROWID" not in row["sql"].upper()
+        ]
+        if old:
+            self._conn.execute("BEGIN")
+        for table in old:
+            self._conn.execute(self._create_sql(f"{table}.new"))
+            self._conn.execute(
+                f"INSERT INTO '{table}.new' SELECT var, val, type FROM '{table}'"
+            )
+            self._conn.execute(f"DROP TABLE '{table}'")
+            self._conn.execute(f"ALTER TABLE '{table}.new' RENAME TO '{table}'")
+        self._conn.commit()
+        if old:
+            logging.info("Converted %s database tables to WITHOUT ROWID", len(old))
+
+    def _execute(
+        self, module: str, sql: str, params=(), many=False
+    ) -> sqlite3.Cursor:
+        with self._lock:
+            if module not in self._tables:
+                self._sql(module)
+                self._conn.execute(self._create_sql(module))
+                self._tables.add(module)
             cursor = self._conn.cursor()
-            return cursor.execute(*args, **kwargs)
-        except sqlite3.OperationalError as e:
-            if str(e).startswith("no such table"):
-                sql = f"""
-                CREATE TABLE IF NOT EXISTS '{module}' (
-                var TEXT UNIQUE NOT NULL,
-                val TEXT NOT NULL,
-                type TEXT NOT NULL
-                )
-                """
-                cursor = self._conn.cursor()
-                cursor.execute(sql)
-                self._conn.commit()
-                return cursor.execute(*args, **kwargs)
-            raise e from None
-        finally:
-            self._lock.release()
+            if many:
+                return cursor.executemany(sql, params)
+            return cursor.execute(sql, params)
 
     def get(self, module: str, variable: str, default=None):
-        sql = f"SELECT * FROM '{module}' WHERE var=?"
-        cur = self._execute(module, sql, (variable,))
-
-        row = cur.fetchone()
-        if row is None:
+        rows = self._read(module, self._sql(module)["get"], (variable,))
+        if not rows:
             return default
-        return self._parse_row(row)
-
-    def set(self, module: str, variable: str, value) -> bool:
-        sql = f"""
-        INSERT INTO '{module}' VALUES ( ?, ?, ? )
-        ON CONFLICT (var) DO
-        UPDATE SET val=?, type=? WHERE var=?
-        """
+        return self._parse_row(rows[0])
 
+    def _encode_value(self, value):
         if isinstance(value, bool):
-            val = "1" if value else "0"
-            typ = "bool"
-        elif isinstance(value, str):
-            val = value
-            typ = "str"
-        elif isinstance(value, int):
-            val = str(value)
-            typ = "int"
-        else:
-            val = json.dumps(value)
-            typ = "json"
+            return "1" if value else "0", "bool"
+        if isinstance(value, str):
+            return value, "str"
+        if isinstance(value, int):
+            return str(value), "int"
+        data = self._codec.dumps(value)
+        if self._compress_threshold and len(data) >= self._compress_threshold:
+            if isinstance(data, str):
+                data = data.encode()
+            return zlib.compress(data), f"{self._codec.name}.z"
+        return data, self._codec.name
 
-        self._execute(module, sql, (variable, val, typ, val, typ, variable))
-        self._conn.commit()
+    def migrate_codec(self, batch_size: int = 500) -> int:
+        codec = self._codec.name
+        migrated = 0
+        for table in self.get_modules():
+            # rows in another format, or ones that should be compressed now
+            sql = f"""
+            SELECT * FROM '{table}' WHERE var > ? AND (
+            type NOT IN ('bool', 'int', 'str', ?, ?)
+            OR type = ? AND ? > 0 AND length(val) >= ?
+            ) ORDER BY var LIMIT ?
+            """
+            threshold = self._compress_threshold
+            last = ""
+            while True:
+                # one short transaction per batch, so the bot keeps going
+                with self._lock:
+                    params = (last, codec, f"{codec}.z", codec, threshold, threshold)
+                    rows = self._execute(table, sql, (*params, batch_size)).fetchall()
+                    if not rows:
+                        break
+                    updates = [
+                        (*self._encode_value(self._parse_row(row)), row["var"])
+                        for row in rows
+                    ]
+                    self._execute(
+                        table,
+                        f"UPDATE '{table}' SET val=?, type=? WHERE var=?",
+                        updates,
+                        many=True,
+                    )
+                    self._commit()
+                last = rows[-1]["var"]
+                migrated += len(rows)
+        if migrated:
+            logging.info("Converted %s database values to %s", migrated, codec)
+        return migrated
+
+    def set(self, module: str, variable: str, value) -> bool:
+        val, typ = self._encode_value(value)
+
+        self._execute(module, self._sql(module)["set"], (variable, val, typ))
+        self._commit()
 
         return True
 
     def remove(self, module: str, variable: str):
-        sql = f"DELETE FROM '{module}' WHERE var=?"
-        self._execute(module, sql, (variable,))
-        self._conn.commit()
+        self._execute(module, self._sql(module)["remove"], (variable,))
+        self._commit()
 
-    def get_collection(self, module: str) -> dict:
-        pattern = r"^(core|custom)"
-        if not re.match(pattern, module):
-            raise ValueError(f"Invalid module name format: {module}")
+    # stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+    _MAX_PARAMS = 500
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        self._sql(module)
+        result = dict.fromkeys(variables, default)
+        keys = list(result)
+        for i in range(0, len(keys), self._MAX_PARAMS):
+            chunk = keys[i : i + self._MAX_PARAMS]
+            marks = ", ".join("?" * len(chunk))
+            sql = f"SELECT * FROM '{module}' WHERE var IN ({marks})"
+            for row in self._read(module, sql, chunk):
+                result[row["var"]] = self._parse_row(row)
+        return result
+
+    def set_many(self, module: str, values: dict):
+        if not values:
+            return
+        rows = [(var, *self._encode_value(value)) for var, value in values.items()]
+        self._execute(module, self._sql(module)["set"], rows, many=True)
+        self._commit()
+
+    def remove_many(self, module: str, variables):
+        keys = list(variables)
+        if not keys:
+            return
+        with self._lock:
+            for i in range(0, len(keys), self._MAX_PARAMS):
+                chunk = keys[i : i + self._MAX_PARAMS]
+                marks = ", ".join("?" * len(chunk))
+                sql = f"DELETE FROM '{module}' WHERE var IN ({marks})"
+                self._execute(module, sql, chunk)
+            self._commit()
+
+    def _query(self, sql: str, params=(), many=False) -> sqlite3.Cursor:
+        with self._lock:
+            cursor = self._conn.cursor()
+            if many:
+                return cursor.executemany(sql, params)
+            return cursor.execute(sql, params)
+
+    def sadd(self, module: str, variable: str, *members):
+        if not members:
+            return
+        sql = "INSERT OR IGNORE INTO _sets VALUES ( ?, ?, ? )"
+        rows = [(module, variable, json.dumps(member)) for member in members]
+        self._query(sql, rows, many=True)
+        self._commit()
 
-        sql = f"SELECT * FROM '{module}'"
-        cur = self._execute(module, sql)
+    def srem(self, module: str, variable: str, *members):
+        if not members:
+            return
+        sql = "DELETE FROM _sets WHERE module=? AND var=? AND member=?"
+        rows = [(module, variable, json.dumps(member)) for member in members]
+        self._query(sql, rows, many=True)
+        self._commit()
+
+    def sismember(self, module: str, variable: str, member) -> bool:
+        sql = "SELECT 1 FROM _sets WHERE module=? AND var=? AND member=?"
+        return bool(self._read(None, sql, (module, variable, json.dumps(member))))
+
+    def smembers(self, module: str, variable: str) -> set:
+        sql = "SELECT member FROM _sets WHERE module=? AND var=?"
+        rows = self._read(None, sql, (module, variable))
+        return {json.loads(row["member"]) for row in rows}
+
+    def _append_chat_history(self, user_id, messages, limit=0, max_tokens=0):
+        rows = [
+            (user_id, json.dumps(message), self._count_tokens(message))
+            for message in messages
+        ]
+        with self._lock:
+            self._query(
+                "INSERT INTO _chat_history (user_id, message, tokens) VALUES (?, ?, ?)",
+                rows,
+                many=True,
+            )
+            if limit:
+                self._query(
+                    """
+                    DELETE FROM _chat_history WHERE user_id = ? AND id <= (
+                    SELECT id FROM _chat_history WHERE user_id = ?
+                    ORDER BY id DESC LIMIT 1 OFFSET ?
+                    )
+                    """,
+                    (user_id, user_id, limit),
+                )
+            if max_tokens:
+                # the newest message is always kept, even if it's over budget
+                self._query(
+                    """
+                    DELETE FROM _chat_history WHERE user_id = ? AND id <= (
+                    SELECT MAX(id) FROM (
+                    SELECT id, SUM(tokens) OVER (ORDER BY id DESC) AS total
+                    FROM _chat_history WHERE user_id = ?
+                    ORDER BY id DESC LIMIT -1 OFFSET 1
+                    ) WHERE total > ?
+                    )
+                    """,
+                    (user_id, user_id, max_tokens),
+                )
+            self._commit()
+
+    def _read_chat_history(self, user_id, limit=None) -> list:
+        rows = self._read(
+            None,
+            "SELECT message FROM _chat_history WHERE user_id = ? "
+            "ORDER BY id DESC LIMIT ?",
+            (user_id, limit or -1),
+        )
+        return [json.loads(row["message"]) for row in rows][::-1]
 
+    def _delete_chat_history(self, user_ids):
+        sql = "DELETE FROM _chat_history WHERE user_id = ?"
+        self._query(sql, [(user_id,) for user_id in user_ids], many=True)
+        self._commit()
+
+    def _file_size(self) -> int:
+        if self._file == ":memory:":
+            return 0
+        return sum(
+            os.path.getsize(path)
+            for path in (self._file, f"{self._file}-wal")
+            if os.path.exists(path)
+        )
+
+    def backup(self, path: str, pages: int = 256, sleep: float = 0.01):
+        """Copy the database to path while it's in use
+
+        Copies a few pages at a time from a separate connection, so writers
+        are never blocked for long. The file at path is replaced at the end.
+        """
+        target = sqlite3.connect(f"{path}.tmp")
+        try:
+            if self._file == ":memory:":
+                with self._lock:
+                    self._conn.backup(target)
+            else:
+                source = self._connect(self._file)
+                try:
+                    source.backup(target, pages=pages, sleep=sleep)
+                finally:
+                    source.close()
+        finally:
+            target.close()
+        os.replace(f"{path}.tmp", path)
+
+    def maintain(
+        self, backup_path: str = None, full: bool = False, step: int = 256
+    ) -> dict:
+        started = time.time()
+        metrics = {"started": started, "size_before": self._file_size()}
+        self.flush()
+
+        with self._lock:
+            incremental = self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+            if not incremental and full:
+                # switching takes one full VACUUM, writes wait for all of it
+                logging.info("Converting the database to incremental vacuum")
+                self._conn.commit()
+                self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self._conn.execute("VACUUM")
+                metrics["converted"] = True
+                incremental = True
+        if not incremental:
+            logging.info("Incremental vacuum is off, run .dbmaint once to enable it")
+
+        # give free pages back in steps, writes can go on in between
+        freed = 0
+        while incremental:
+            with self._lock:
+                free = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free:
+                    break
+                # execute() would only step it once, freeing a single page
+                self._conn.executescript(f"PRAGMA incremental_vacuum({step});")
+                freed += min(free, step)
+        metrics["freed_pages"] = freed
+
+        with self._lock:
+            # bounded ANALYZE, only samples each index
+            self._conn.execute("PRAGMA analysis_limit=400")
+            self._conn.execute("ANALYZE")
+            self._conn.execute("PRAGMA optimize")
+            self._conn.commit()
+            if self._readers is not None:
+                self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+        if backup_path:
+            backup_started = time.time()
+            self.backup(backup_path)
+            metrics["backup"] = backup_path
+            metrics["backup_duration"] = round(time.time() - backup_started, 3)
+
+        metrics["size_after"] = self._file_size()
+        metrics["duration"] = round(time.time() - started, 3)
+        return metrics
+
+    def get_modules(self) -> list:
+        return sorted(
+            table for table in list(self._tables) if re.match(r"^(core|custom)", table)
+        )
+
+    def iter_collection(self, module: str, batch_size: int = 500, after: str = None):
+        self._sql(module)
+        first = f"SELECT * FROM '{module}' ORDER BY var LIMIT ?"
+        sql = f"SELECT * FROM '{module}' WHERE var > ? ORDER BY var LIMIT ?"
+        if after is None:
+            rows = self._read(module, first, (batch_size,))
+        else:
+            rows = self._read(module, sql, (after, batch_size))
+        while True:
+            for row in rows:
+                yield row["var"], self._parse_row(row)
+            if len(rows) < batch_size:
+                return
+            rows = self._read(module, sql, (rows[-1]["var"], batch_size))
+
+    def iter_sets(self, after: tuple = None):
+        sql = "SELECT DISTINCT module, var FROM _sets"
+        params = ()
+        if after is not None:
+            sql += " WHERE module > ? OR (module = ? AND var > ?)"
+            params = (after[0], after[0], after[1])
+        for row in self._read(None, sql + " ORDER BY module, var", params):
+            yield row["module"], row["var"], self.smembers(row["module"], row["var"])
+
+    def iter_chat_histories(self, after: int = None):
+        sql = "SELECT DISTINCT user_id FROM _chat_history"
+        params = ()
+        if after is not None:
+            sql += " WHERE user_id > ?"
+            params = (after,)
+        for row in self._read(None, sql + " ORDER BY user_id", params):
+            yield row["user_id"], self._read_chat_history(row["user_id"])
+
+    def get_collection(self, module: str) -> dict:
         collection = {}
-        for row in cur:
+        for row in self._read(module, self._sql(module)["all"]):
             collection[row["var"]] = self._parse_row(row)
 
         return collection
 
+    def _commit(self):
+        with self._lock:
+            if self._tx_depth:
+                return
+            if not self._batch_interval:
+                self._conn.commit()
+                return
+            self._pending += 1
+            if self._pending >= self._batch_size:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._batch_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._pending = 0
+            if not self._tx_depth:
+                self._conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Commit all writes made inside the block at once
+
+        The lock is held for the whole block, so keep it free of awaits.
+        """
+        with self._lock:
+            if not self._tx_depth:
+                self.flush()
+            self._tx_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._tx_depth -= 1
+                if not self._tx_depth:
+                    self._conn.rollback()
+                raise
+            self._tx_depth -= 1
+            if not self._tx_depth:
+                self._conn.commit()
+
     def close(self):
-        self._conn.commit()
+        self._executor.shutdown()
+        self.flush()
         self._conn.close()
+        while self._readers is not None and not self._readers.empty():
+            self._readers.get().close()
 
-    def add_chat_history(self, user_id, message):
-        chat_history = self.get_chat_history(user_id, default=[])
-        chat_history.append(message)
-        self.set(f"core.cohere.user_{user_id}", "chat_history", chat_history)
 
-    def get_chat_history(self, user_id, default=None):
-        if default is None:
-            default = []
-        return self.get(f"core.cohere.user_{user_id}", "chat_history", default=[])
+class DatabaseWrapper(Database):
+    """Base for layers that add behaviour on top of another database"""
 
-    def addaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id not in chatai_users:
-            chatai_users.append(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+    def __init__(self, backend: Database):
+        self._backend = backend
+        self._history_migrated = set()
 
-    def remaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id in chatai_users:
-            chatai_users.remove(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+    def get(self, module: str, variable: str, default=None):
+        return self._backend.get(module, variable, default)
 
-    def getaiusers(self):
-        return self.get("core.chatbot", "chatai_users", default=[])
+    def set(self, module: str, variable: str, value):
+        return self._backend.set(module, variable, value)
+
+    def remove(self, module: str, variable: str):
+        return self._backend.remove(module, variable)
+
+    def get_collection(self, module: str) -> dict:
+        return self._backend.get_collection(module)
+
+    def close(self):
+        self._backend.close()
+
+    async def aclose(self):
+        await self._backend.aclose()
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        return self._backend.get_many(module, variables, default)
+
+    def set_many(self, module: str, values: dict):
+        return self._backend.set_many(module, values)
+
+    def remove_many(self, module: str, variables):
+        return self._backend.remove_many(module, variables)
+
+    async def aget_many(self, module: str, variables, default=None) -> dict:
+        return await self._backend.aget_many(module, variables, default)
+
+    async def aset_many(self, module: str, values: dict):
+        return await self._backend.aset_many(module, values)
+
+    async def aremove_many(self, module: str, variables):
+        return await self._backend.aremove_many(module, variables)
+
+    def sadd(self, module: str, variable: str, *members):
+        return self._backend.sadd(module, variable, *members)
+
+    def srem(self, module: str, variable: str, *members):
+        return self._backend.srem(module, variable, *members)
+
+    def sismember(self, module: str, variable: str, member) -> bool:
+        return self._backend.sismember(module, variable, member)
+
+    def smembers(self, module: str, variable: str) -> set:
+        return self._backend.smembers(module, variable)
+
+    async def asadd(self, module: str, variable: str, *members):
+        return await self._backend.asadd(module, variable, *members)
+
+    async def asrem(self, module: str, variable: str, *members):
+        return await self._backend.asrem(module, variable, *members)
+
+    async def asismember(self, module: str, variable: str, member) -> bool:
+        return await self._backend.asismember(module, variable, member)
+
+    async def asmembers(self, module: str, variable: str) -> set:
+        return await self._backend.asmembers(module, variable)
+
+    # chat history is migrated and trimmed here, so legacy keys are removed
+    # through the layers above the backend
+
+    def _append_chat_history(self, user_id, messages, limit=0, max_tokens=0):
+        return self._backend._append_chat_history(
+            user_id, messages, limit, max_tokens
+        )
+
+    def _read_chat_history(self, user_id, limit=None) -> list:
+        return self._backend._read_chat_history(user_id, limit)
+
+    def _delete_chat_history(self, user_ids):
+        return self._backend._delete_chat_history(user_ids)
+
+    @contextmanager
+    def transaction(self):
+        with self._backend.transaction():
+            yield self
+
+    def flush(self):
+        self._backend.flush()
+
+    def invalidate(self, module: str = None, variable: str = None):
+        return self._backend.invalidate(module, variable)
+
+    def subscribe(self, module: str, callback):
+        return self._backend.subscribe(module, callback)
+
+    def follow(self, source: "MongoDatabase", loop: asyncio.AbstractEventLoop):
+        return self._backend.follow(source, loop)
+
+    def migrate_codec(self, batch_size: int = 500) -> int:
+        return self._backend.migrate_codec(batch_size)
+
+    def maintain(self, backup_path: str = None, full: bool = False) -> dict:
+        return self._backend.maintain(backup_path, full)
+
+    def get_modules(self) -> list:
+        return self._backend.get_modules()
+
+    def iter_collection(self, module: str, batch_size: int = 500, after: str = None):
+        return self._backend.iter_collection(module, batch_size, after)
+
+    def iter_sets(self, after: tuple = None):
+        return self._backend.iter_sets(after)
+
+    def iter_chat_histories(self, after: int = None):
+        return self._backend.iter_chat_histories(after)
+
+    async def aget(self, module: str, variable: str, default=None):
+        return await self._backend.aget(module, variable, default)
+
+    async def aset(self, module: str, variable: str, value):
+        return await self._backend.aset(module, variable, value)
+
+    async def aremove(self, module: str, variable: str):
+        return await self._backend.aremove(module, variable)
+
+    async def aget_collection(self, module: str) -> dict:
+        return await self._backend.aget_collection(module)
+
+
+_MISSING = object()
+
+
+class CachedDatabase(DatabaseWrapper):
+    """Write-through LRU read cache
+
+    Values are bounded both by entry count and by their approximate
+    encoded size. Missing keys are cached too, so repeated lookups of
+    absent variables don't reach the backend either.
+
+    Returned lists and dicts are shared with the cache: mutate them only
+    right before writing them back with ``set``.
+    """
+
+    def __init__(self, backend: Database, max_entries=1024, max_bytes=8 << 20):
+        super().__init__(backend)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(value) -> int:
+        if isinstance(value, (set, frozenset)):
+            value = list(value)
+        if isinstance(value, (dict, list)):
+            return len(json.dumps(value, default=str))
+        if isinstance(value, str):
+            return len(value)
+        return sys.getsizeof(value)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _store(self, key, value, version=None):
+        size = self._sizeof(value)
+        with self._lock:
+            if version is not None and version != self._version:
+                # a write happened while we were reading, value may be stale
+                return
+            self._drop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def _written(self, key, value):
+        with self._lock:
+            self._version += 1
+        self._store(key, value)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], None
+            self.misses += 1
+            return None, self._version
+
+    def get(self, module: str, variable: str, default=None):
+        key = (module, variable)
+        value, version = self._lookup(key)
+        if version is None:
+            return default if value is _MISSING else value
+
+        value = self._backend.get(module, variable, _MISSING)
+        self._store(key, value, version)
+        return default if value is _MISSING else value
+
+    def set(self, module: str, variable: str, value):
+        result = self._backend.set(module, variable, value)
+        self._written((module, variable), value)
+        return result
+
+    def remove(self, module: str, variable: str):
+        self._backend.remove(module, variable)
+        self._written((module, variable), _MISSING)
+
+    async def aget(self, module: str, variable: str, default=None):
+        key = (module, variable)
+        value, version = self._lookup(key)
+        if version is None:
+            return default if value is _MISSING else value
+
+        value = await self._backend.aget(module, variable, _MISSING)
+        self._store(key, value, version)
+        return default if value is _MISSING else value
+
+    async def aset(self, module: str, variable: str, value):
+        result = await self._backend.aset(module, variable, value)
+        self._written((module, variable), value)
+        return result
+
+    async def aremove(self, module: str, variable: str):
+        await self._backend.aremove(module, variable)
+        self._written((module, variable), _MISSING)
+
+    def _lookup_many(self, module: str, variables):
+        found, missing, first_version = {}, [], None
+        for var in variables:
+            value, version = self._lookup((module, var))
+            if version is None:
+                found[var] = value
+            else:
+                missing.append(var)
+                if first_version is None:
+                    first_version = version
+        return found, missing, first_version
+
+    def _merge_many(self, module, found, fetched, version, default):
+        for var, value in fetched.items():
+            self._store((module, var), value, version)
+        found.update(fetched)
+        return {
+            var: default if value is _MISSING else value
+            for var, value in found.items()
+        }
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        found, missing, version = self._lookup_many(module, variables)
+        fetched = self._backend.get_many(module, missing, _MISSING) if missing else {}
+        return self._merge_many(module, found, fetched, version, default)
+
+    async def aget_many(self, module: str, variables, default=None) -> dict:
+        found, missing, version = self._lookup_many(module, variables)
+        fetched = (
+            await self._backend.aget_many(module, missing, _MISSING) if missing else {}
+        )
+        return self._merge_many(module, found, fetched, version, default)
+
+    def set_many(self, module: str, values: dict):
+        self._backend.set_many(module, values)
+        for var, value in values.items():
+            self._written((module, var), value)
+
+    async def aset_many(self, module: str, values: dict):
+        await self._backend.aset_many(module, values)
+        for var, value in values.items():
+            self._written((module, var), value)
+
+    def remove_many(self, module: str, variables):
+        variables = list(variables)
+        self._backend.remove_many(module, variables)
+        for var in variables:
+            self._written((module, var), _MISSING)
+
+    async def aremove_many(self, module: str, variables):
+        variables = list(variables)
+        await self._backend.aremove_many(module, variables)
+        for var in variables:
+            self._written((module, var), _MISSING)
+
+    # sets are cached whole under their own key, so membership checks are
+    # a lookup in the cached set
+
+    def _cached_set(self, module: str, variable: str):
+        value, version = self._lookup((module, variable, set))
+        if version is None:
+            return value, None
+        return None, version
+
+    def smembers(self, module: str, variable: str) -> set:
+        members, version = self._cached_set(module, variable)
+        if version is not None:
+            members = self._backend.smembers(module, variable)
+            self._store((module, variable, set), members, version)
+        return set(members)
+
+    async def asmembers(self, module: str, variable: str) -> set:
+        members, version = self._cached_set(module, variable)
+        if version is not None:
+            members = await self._backend.asmembers(module, variable)
+            self._store((module, variable, set), members, version)
+        return set(members)
+
+    def sismember(self, module: str, variable: str, member) -> bool:
+        members, version = self._cached_set(module, variable)
+        if version is not None:
+            members = self._backend.smembers(module, variable)
+            self._store((module, variable, set), members, version)
+        return member in members
+
+    async def asismember(self, module: str, variable: str, member) -> bool:
+        members, version = self._cached_set(module, variable)
+        if version is not None:
+            members = await self._backend.asmembers(module, variable)
+            self._store((module, variable, set), members, version)
+        return member in members
+
+    def _set_written(self, module: str, variable: str, added=(), removed=()):
+        key = (module, variable, set)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            with self._lock:
+                self._version += 1
+            return
+        self._written(key, (entry[0] | set(added)) - set(removed))
+
+    def sadd(self, module: str, variable: str, *members):
+        self._backend.sadd(module, variable, *members)
+        self._set_written(module, variable, added=members)
+
+    async def asadd(self, module: str, variable: str, *members):
+        await self._backend.asadd(module, variable, *members)
+        self._set_written(module, variable, added=members)
+
+    def srem(self, module: str, variable: str, *members):
+        self._backend.srem(module, variable, *members)
+        self._set_written(module, variable, removed=members)
+
+    async def asrem(self, module: str, variable: str, *members):
+        await self._backend.asrem(module, variable, *members)
+        self._set_written(module, variable, removed=members)
+
+    @contextmanager
+    def transaction(self):
+        try:
+            with self._backend.transaction():
+                yield self
+        except BaseException:
+            # rolled back writes were already cached
+            self.invalidate()
+            raise
+
+    def invalidate(self, module: str = None, variable: str = None):
+        """Forget cached values of a variable, a module or everything"""
+        with self._lock:
+            self._version += 1
+            if module is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif variable is not None:
+                self._drop((module, variable))
+                self._drop((module, variable, set))
+            else:
+                for key in [k for k in self._entries if k[0] == module]:
+                    self._drop(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+# passed to subscribers in place of the value of a removed key
+DELETED = object()
+# passed to subscribers when members of the set ``variable`` changed
+SET_CHANGED = object()
+
+
+class NotifyingDatabase(DatabaseWrapper):
+    """Publishes an event for every key written
+
+    Subscribers are called in the thread that made the write, so keep them
+    short. Changes made by other instances are delivered on the event loop
+    given to ``follow``. ``variable`` is None when the whole module may have
+    changed.
+    """
+
+    def __init__(self, backend: Database):
+        super().__init__(backend)
+        self._subscribers = {}
+
+    def subscribe(self, module: str, callback):
+        self._subscribers.setdefault(module, []).append(callback)
+
+    def _publish(self, module: str, variable, value):
+        for callback in self._subscribers.get(module, ()):
+            try:
+                callback(module, variable, value)
+            except Exception:
+                logging.exception("Subscriber of %s failed", module)
+
+    def _publish_many(self, module: str, values: dict):
+        if module in self._subscribers:
+            for var, value in values.items():
+                self._publish(module, var, value)
+
+    def set(self, module: str, variable: str, value):
+        result = self._backend.set(module, variable, value)
+        self._publish(module, variable, value)
+        return result
+
+    def remove(self, module: str, variable: str):
+        self._backend.remove(module, variable)
+        self._publish(module, variable, DELETED)
+
+    def set_many(self, module: str, values: dict):
+        self._backend.set_many(module, values)
+        self._publish_many(module, values)
+
+    def remove_many(self, module: str, variables):
+        variables = list(variables)
+        self._backend.remove_many(module, variables)
+        self._publish_many(module, dict.fromkeys(variables, DELETED))
+
+    async def aset(self, module: str, variable: str, value):
+        result = await self._backend.aset(module, variable, value)
+        self._publish(module, variable, value)
+        return result
+
+    async def aremove(self, module: str, variable: str):
+        await self._backend.aremove(module, variable)
+        self._publish(module, variable, DELETED)
+
+    async def aset_many(self, module: str, values: dict):
+        await self._backend.aset_many(module, values)
+        self._publish_many(module, values)
+
+    async def aremove_many(self, module: str, variables):
+        variables = list(variables)
+        await self._backend.aremove_many(module, variables)
+        self._publish_many(module, dict.fromkeys(variables, DELETED))
+
+    def sadd(self, module: str, variable: str, *members):
+        result = self._backend.sadd(module, variable, *members)
+        self._publish(module, variable, SET_CHANGED)
+        return result
+
+    def srem(self, module: str, variable: str, *members):
+        result = self._backend.srem(module, variable, *members)
+        self._publish(module, variable, SET_CHANGED)
+        return result
+
+    async def asadd(self, module: str, variable: str, *members):
+        result = await self._backend.asadd(module, variable, *members)
+        self._publish(module, variable, SET_CHANGED)
+        return result
+
+    async def asrem(self, module: str, variable: str, *members):
+        result = await self._backend.asrem(module, variable, *members)
+        self._publish(module, variable, SET_CHANGED)
+        return result
+
+    @contextmanager
+    def transaction(self):
+        try:
+            with self._backend.transaction():
+                yield self
+        except BaseException:
+            # events of rolled back writes were already published
+            for module in list(self._subscribers):
+                self._publish(module, None, None)
+            raise
+
+    def follow(self, source: "MongoDatabase", loop: asyncio.AbstractEventLoop):
+        """Pick up changes other instances make to a shared database"""
+        self._loop = loop
+        threading.Thread(
+            target=source.watch,
+            args=(self._remote_change,),
+            name="db-changes",
+            daemon=True,
+        ).start()
+
+    def _remote_change(self, module, variable):
+        # runs in the watcher thread, subscribers only ever run on the loop
+        self._backend.invalidate(module, variable)
+        if module is None:
+            for subscribed in list(self._subscribers):
+                self._loop.call_soon_threadsafe(self._publish, subscribed, None, None)
+        elif variable is None:
+            self._loop.call_soon_threadsafe(self._publish, module, None, None)
+        elif module in self._subscribers:
+            value = self._backend.get(module, variable, DELETED)
+            self._loop.call_soon_threadsafe(self._publish, module, variable, value)
+
+
+class ExpiringDatabase(DatabaseWrapper):
+    """Keys with a time to live
+
+    Expiry times are kept in the ``core.expiry`` module and mirrored in
+    memory. Expired keys read as missing right away, ``run_reaper`` removes
+    them and calls the callbacks registered with ``on_expire``. A key set
+    again without ``ttl`` no longer expires.
+    """
+
+    META_MODULE = "core.expiry"
+
+    def __init__(self, backend: Database, retry_delay=60 * 60):
+        super().__init__(backend)
+        # how long to wait before retrying a key whose callback failed
+        self.retry_delay = retry_delay
+        self._expires = {}
+        self._heap = []
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+        for meta, expires in backend.get_collection(self.META_MODULE).items():
+            module, variable = json.loads(meta)
+            self._expires[(module, variable)] = expires
+            self._heap.append((expires, module, variable))
+        heapq.heapify(self._heap)
+
+    def on_expire(self, module: str, callback):
+        """Call ``callback(module, variable, value)`` when a key of module expires
+
+        The callback may be a coroutine function. If it raises, the key is
+        kept and retried later.
+        """
+        self._callbacks.setdefault(module, []).append(callback)
+
+    def _expired(self, module: str, variable: str) -> bool:
+        expires = self._expires.get((module, variable))
+        return expires is not None and expires <= time.time()
+
+    def _track(self, module: str, variables, ttl):
+        # returns expiry records to write and to remove from META_MODULE
+        if ttl is None and not self._expires:
+            return {}, []
+        now = time.time()
+        store, drop = {}, []
+        with self._lock:
+            for variable in variables:
+                key = (module, variable)
+                if ttl is not None:
+                    self._expires[key] = now + ttl
+                    heapq.heappush(self._heap, (now + ttl, module, variable))
+                    store[json.dumps(key)] = now + ttl
+                elif self._expires.pop(key, None) is not None:
+                    drop.append(json.dumps(key))
+        return store, drop
+
+    def _persist(self, store: dict, drop: list):
+        if store:
+            self._backend.set_many(self.META_MODULE, store)
+        if drop:
+            self._backend.remove_many(self.META_MODULE, drop)
+
+    async def _apersist(self, store: dict, drop: list):
+        if store:
+            await self._backend.aset_many(self.META_MODULE, store)
+        if drop:
+            await self._backend.aremove_many(self.META_MODULE, drop)
+
+    def _hide_expired(self, module: str, values: dict, default=None) -> dict:
+        if self._expires:
+            for var in values:
+                if self._expired(module, var):
+                    values[var] = default
+        return values
+
+    def get(self, module: str, variable: str, default=None):
+        if self._expired(module, variable):
+            return default
+        return self._backend.get(module, variable, default)
+
+    def set(self, module: str, variable: str, value, ttl: float = None):
+        result = self._backend.set(module, variable, value)
+        self._persist(*self._track(module, [variable], ttl))
+        return result
+
+    def remove(self, module: str, variable: str):
+        self._backend.remove(module, variable)
+        self._persist(*self._track(module, [variable], None))
+
+    def get_collection(self, module: str) -> dict:
+        collection = self._backend.get_collection(module)
+        for var in [var for var in collection if self._expired(module, var)]:
+            del collection[var]
+        return collection
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        values = self._backend.get_many(module, variables, default)
+        return self._hide_expired(module, values, default)
+
+    def set_many(self, module: str, values: dict, ttl: float = None):
+        self._backend.set_many(module, values)
+        self._persist(*self._track(module, values, ttl))
+
+    def remove_many(self, module: str, variables):
+        variables = list(variables)
+        self._backend.remove_many(module, variables)
+        self._persist(*self._track(module, variables, None))
+
+    async def aget(self, module: str, variable: str, default=None):
+        if self._expired(module, variable):
+            return default
+        return await self._backend.aget(module, variable, default)
+
+    async def aset(self, module: str, variable: str, value, ttl: float = None):
+        result = await self._backend.aset(module, variable, value)
+        await self._apersist(*self._track(module, [variable], ttl))
+        return result
+
+    async def aremove(self, module: str, variable: str):
+        await self._backend.aremove(module, variable)
+        await self._apersist(*self._track(module, [variable], None))
+
+    async def aget_collection(self, module: str) -> dict:
+        collection = await self._backend.aget_collection(module)
+        for var in [var for var in collection if self._expired(module, var)]:
+            del collection[var]
+        return collection
+
+    async def aget_many(self, module: str, variables, default=None) -> dict:
+        values = await self._backend.aget_many(module, variables, default)
+        return self._hide_expired(module, values, default)
+
+    async def aset_many(self, module: str, values: dict, ttl: float = None):
+        await self._backend.aset_many(module, values)
+        await self._apersist(*self._track(module, values, ttl))
+
+    async def aremove_many(self, module: str, variables):
+        variables = list(variables)
+        await self._backend.aremove_many(module, variables)
+        await self._apersist(*self._track(module, variables, None))
+
+    def _due(self) -> list:
+        now = time.time()
+        due = set()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, module, variable = heapq.heappop(self._heap)
+                # entries of keys that were set again are stale
+                if self._expired(module, variable):
+                    due.add((module, variable))
+        return sorted(due)
+
+    async def reap(self) -> int:
+        """Remove expired keys now, returns how many were removed"""
+        removed = 0
+        for module, variable in self._due():
+            value = await self._backend.aget(module, variable)
+            try:
+                for callback in self._callbacks.get(module, ()):
+                    result = callback(module, variable, value)
+                    if inspect.isawaitable(result):
+                        await result
+            except Exception:
+                logging.exception("Expiry callback failed for %s %s", module, variable)
+                with self._lock:
+                    heapq.heappush(
+                        self._heap, (time.time() + self.retry_delay, module, variable)
+                    )
+                continue
+            if self._expired(module, variable):
+                await self.aremove(module, variable)
+                removed += 1
+        return removed
+
+    async def run_reaper(self, max_sleep=60):
+        """Reap expired keys as they come due, forever"""
+        while True:
+            try:
+                await self.reap()
+            except Exception:
+                logging.exception("Error while removing expired keys")
+            with self._lock:
+                delay = self._heap[0][0] - time.time() if self._heap else max_sleep
+            await asyncio.sleep(min(max(delay, 0), max_sleep))
 
 
 if config.db_type in ["mongo", "mongodb"]:
-    db = MongoDatabase(config.db_url, config.db_name)
+    backend = MongoDatabase(config.db_url, config.db_name, config.db_mongo_layout)
 else:
-    db = SqliteDatabase(config.db_name)
+    backend = SqliteDatabase(
+        config.db_name,
+        config.db_batch_interval,
+        config.db_batch_size,
+        config.db_codec,
+        config.db_compress_threshold,
+        config.db_readers,
+    )
+
+db = backend
+if config.db_cache_size > 0:
+    db = CachedDatabase(db, config.db_cache_size, config.db_cache_bytes)
+
+db = NotifyingDatabase(db)
+
+db = ExpiringDatabase(db)
+
+# values that used to be stored as JSON lists
+for _module, _variable in (
+    ("core.chatbot", "chatai_users"),
+    ("custom.modules", "allModules"),
+    ("core.sessionkiller", "auths_hashes"),
+):
+    db.list_to_set(_module, _variable)
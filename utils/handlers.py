@@ -15,21 +15,22 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import re
+import asyncio
+import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Dict, Union
 
 from pyrogram import Client
-from pyrogram.enums import ChatType
+from pyrogram.enums import ChatType, MessageEntityType
 from pyrogram.errors import (
     ChatAdminRequired,
-    PeerIdInvalid,
+    FloodWait,
     RPCError,
     UserAdminInvalid,
-    UsernameInvalid,
 )
-from pyrogram.raw import functions, types
+from pyrogram.raw import functions
 from pyrogram.types import (
-    ChatPermissions,
     ChatPrivileges,
     InputMediaAudio,
     InputMediaDocument,
@@ -42,11 +43,13 @@ from pyrogram.utils import (
     MAX_USER_ID,
     MIN_CHANNEL_ID,
     MIN_CHAT_ID,
-    get_channel_id,
 )
 
+from utils import bulk as bulk_actions
+from utils.bulk import BulkAction
 from utils.db import db
 from utils.misc import prefix
+from utils.peers import peer_cache
 from utils.scripts import format_exc, text
 
 
@@ -86,91 +89,199 @@ async def get_user_and_name(message):
         )
 
 
-class BanHandler:
-    def __init__(self, client: Client, message: Message):
-        self.client = client
-        self.message = message
-        self.cause = text(message)
-        self.channel = None
-        self.user_id = None
-        self.name = None
+# usernames and ids taken as more targets after the first one
+TARGET_RE = re.compile(r"@\w{4,}|-?\d{5,}")
 
-    async def handle_ban(self):
-        if self.message.reply_to_message:
-            await self.handle_reply_ban()
-        elif not self.message.reply_to_message:
-            await self.handle_non_reply_ban()
+
+async def resolve_targets(client: Client, tokens: list) -> tuple:
+    """Look up usernames and ids in one batch
+
+    Returns a dict of found ids to names and a list of tokens not found.
+    """
+    user_ids, channel_ids, usernames, not_found = [], [], [], []
+    for token in tokens:
+        try:
+            peer_type = await check_username_or_id(token)
+        except ValueError:
+            not_found.append(token)
+            continue
+        if peer_type == "user":
+            user_ids.append(int(token))
+        elif peer_type == "channel" and token.lstrip("-").isdigit():
+            channel_ids.append(int(token))
+        elif peer_type == "channel":
+            usernames.append(token)
         else:
-            await self.message.edit("<b>Unsupported</b>")
+            not_found.append(token)
+
+    users = await peer_cache.get_users(client, user_ids)
+    channels = await peer_cache.get_channels(client, channel_ids)
+    chats = await asyncio.gather(
+        *[peer_cache.get_chat(client, username) for username in usernames],
+        return_exceptions=True,
+    )
+
+    found = {}
+    for token, chat in zip(usernames, chats):
+        if isinstance(chat, RPCError):
+            not_found.append(token)
+        elif isinstance(chat, BaseException):
+            raise chat
+        else:
+            found[token] = chat
 
-    async def handle_reply_ban(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            user_for_ban, self.name = await get_user_and_name(self.message)
-            await self.ban_user(user_for_ban)
+    targets = {}
+    for token in tokens:
+        peer = found.get(token)
+        if peer is None and token.lstrip("-").isdigit():
+            peer = users.get(int(token)) or channels.get(int(token))
+        if peer is None:
+            if token not in not_found:
+                not_found.append(token)
+            continue
+        targets[peer.id] = peer_name(peer)
+    return targets, not_found
 
-    async def handle_non_reply_ban(self):
-        if (
-            self.message.chat.type not in ["private", "channel"]
-            and len(self.cause.split()) > 1
-        ):
-            user_to_ban = await self.get_user_to_ban()
-            if user_to_ban:
-                self.name = (
-                    user_to_ban.first_name
-                    if getattr(user_to_ban, "first_name", None)
-                    else user_to_ban.title
-                )
-                await self.ban_user(user_to_ban.id)
 
-    async def get_user_to_ban(self):
-        user_type = await check_username_or_id(self.cause.split(" ")[1])
-        if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
-        if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
-        await self.message.edit("<b>Invalid user type</b>")
-        return None
+def peer_name(peer) -> str:
+    return (
+        getattr(peer, "first_name", None)
+        or getattr(peer, "title", None)
+        or str(peer.id)
+    )
+
+
+class MultiTargetHandler:
+    """Base of moderation commands taking several targets
+
+    The target is the sender of the replied message. Replying to a message
+    of your own takes every user mentioned in it instead, and without a reply
+    the targets are the first word and every username or id after it. They
+    are looked up in one batch, handled concurrently and reported in one edit.
+    """
 
-    async def ban_user(self, user_id):
+    options = ()
+    done_text = "done!"
+
+    def __init__(self, client: Client, message: Message):
+        self.client = client
+        self.message = message
+        self.cause = text(message)
+        self.chat_id = message.chat.id
+        words = self.cause.split()[1:]
+        self.flags = {word.lower() for word in words if word.lower() in self.options}
+        self.words = [word for word in words if word.lower() not in self.options]
+        self.args = self.words
+        self.not_found = []
+
+    async def handle(self):
+        if self.message.chat.type in [ChatType.PRIVATE, ChatType.CHANNEL]:
+            return await self.message.edit("<b>Unsupported</b>")
         try:
-            await self.client.ban_chat_member(self.message.chat.id, user_id)
-            self.channel = await self.client.resolve_peer(self.message.chat.id)
-            self.user_id = await self.client.resolve_peer(user_id)
-            await self.handle_additional_actions()
-            await self.edit_message()
-        except UserAdminInvalid:
-            await self.message.edit("<b>No rights</b>")
-        except ChatAdminRequired:
-            await self.message.edit("<b>No rights</b>")
+            targets = await self.get_targets()
         except Exception as e:
-            await self.message.edit(format_exc(e))
+            return await self.message.edit(format_exc(e))
+        if not targets:
+            if self.not_found:
+                return await self.message.edit("<b>User is not found</b>")
+            return await self.message.edit("<b>user_id or username</b>")
 
-    async def handle_additional_actions(self):
-        if "report_spam" in self.cause.lower().split():
+        self.action = self.make_action()
+        bulk = BulkAction(None, self.apply, workers=4)
+        try:
+            await bulk.run(list(targets))
+        except Exception as e:
+            return await self.message.edit(format_exc(e))
+        await self.message.edit(self.construct_message(targets, bulk.errors))
+
+    async def get_targets(self) -> dict:
+        reply = self.message.reply_to_message
+        if reply and not reply.outgoing:
+            sender = await get_user_and_name(self.message)
+            return dict([sender]) if sender else {}
+
+        if reply:
+            reply_text = text(reply) or ""
+            targets = {
+                entity.user.id: peer_name(entity.user)
+                for entity in reply.entities or reply.caption_entities or []
+                if entity.type == MessageEntityType.TEXT_MENTION
+            }
+            found, self.not_found = await resolve_targets(
+                self.client, TARGET_RE.findall(reply_text)
+            )
+            return {**targets, **found}
+
+        if not self.words:
+            return {}
+        count = 1
+        while count < len(self.words) and TARGET_RE.fullmatch(self.words[count]):
+            count += 1
+        self.args = self.words[count:]
+        targets, self.not_found = await resolve_targets(self.client, self.words[:count])
+        return targets
+
+    def make_action(self):
+        """Build the call made for every target, usually one from utils.bulk"""
+        raise NotImplementedError
+
+    async def apply(self, user_id):
+        await self.action(user_id)
+        await self.handle_additional_actions(user_id)
+
+    async def handle_additional_actions(self, user_id):
+        if not self.flags:
+            return
+        channel = await peer_cache.resolve_peer(self.client, self.chat_id)
+        participant = await peer_cache.resolve_peer(self.client, user_id)
+        reply = self.message.reply_to_message
+        if "report_spam" in self.flags and reply and not reply.outgoing:
             await self.client.invoke(
                 functions.channels.ReportSpam(
-                    channel=self.channel,
-                    participant=self.user_id,
-                    id=[self.message.reply_to_message.id],
+                    channel=channel, participant=participant, id=[reply.id]
                 )
             )
-        if "delete_history" in self.cause.lower().split():
+        if "delete_history" in self.flags:
             await self.client.invoke(
                 functions.channels.DeleteParticipantHistory(
-                    channel=self.channel, participant=self.user_id
+                    channel=channel, participant=participant
                 )
             )
 
-    async def edit_message(self):
-        text_c = "".join(
-            f" {_}"
-            for _ in self.cause.split()
-            if _.lower() not in ["delete_history", "report_spam"]
-        )
-        await self.message.edit(
-            f"<b>{self.name}</b> <code>banned!</code>"
-            + f"\n{'<b>Cause:</b> <i>' + text_c.split(maxsplit=1)[1] + '</i>' if len(text_c.split()) > 1 else ''}"
-        )
+    def construct_done_message(self, names: str) -> str:
+        return f"<b>{names}</b> <code>{self.done_text}</code>"
+
+    def construct_cause(self) -> str:
+        if not self.args:
+            return ""
+        return f"\n<b>Cause:</b> <i>{' '.join(self.args)}</i>"
+
+    def construct_message(self, targets: dict, errors: dict) -> str:
+        lines = []
+        done = [name for user_id, name in targets.items() if user_id not in errors]
+        if done:
+            lines.append(self.construct_done_message(", ".join(done)))
+        for user_id, e in errors.items():
+            if isinstance(e, (UserAdminInvalid, ChatAdminRequired)):
+                lines.append(f"<b>{targets[user_id]}:</b> <code>No rights</code>")
+            else:
+                lines.append(
+                    f"<b>{targets[user_id]}:</b> <code>{e.ID or e.__class__.__name__}</code>"
+                )
+        if self.not_found:
+            lines.append(f"<b>Not found:</b> <code>{' '.join(self.not_found)}</code>")
+        return "\n".join(lines) + self.construct_cause()
+
+
+class BanHandler(MultiTargetHandler):
+    options = ("delete_history", "report_spam")
+    done_text = "banned!"
+
+    async def handle_ban(self):
+        await self.handle()
+
+    def make_action(self):
+        return bulk_actions.ban(self.client, self.chat_id)
 
 
 class UnbanHandler:
@@ -212,17 +323,19 @@ class UnbanHandler:
     async def get_user_to_unban(self):
         user_type = await check_username_or_id(self.cause.split(" ")[1])
         if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
+            return await peer_cache.get_chat(self.client, self.cause.split(" ")[1])
         if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
+            return await peer_cache.get_user(self.client, self.cause.split(" ")[1])
         await self.message.edit("<b>Invalid user type</b>")
         return None
 
     async def unban_user(self, user_id):
         try:
-            await self.client.unban_chat_member(self.message.chat.id, user_id)
-            self.channel = await self.client.resolve_peer(self.message.chat.id)
-            self.user_id = await self.client.resolve_peer(user_id)
+            await bulk_actions.unban(self.client, self.message.chat.id)(user_id)
+            self.channel = await peer_cache.resolve_peer(
+                self.client, self.message.chat.id
+            )
+            self.user_id = await peer_cache.resolve_peer(self.client, user_id)
             await self.edit_message()
         except UserAdminInvalid:
             await self.message.edit("<b>No rights</b>")
@@ -243,99 +356,15 @@ class UnbanHandler:
         )
 
 
-class KickHandler:
-    def __init__(self, client: Client, message: Message):
-        self.client = client
-        self.message = message
-        self.cause = text(message)
-        self.channel = None
-        self.user_id = None
-        self.name = None
+class KickHandler(MultiTargetHandler):
+    options = ("delete_history", "report_spam")
+    done_text = "kicked!"
 
     async def handle_kick(self):
-        if self.message.reply_to_message:
-            await self.handle_reply_kick()
-        elif not self.message.reply_to_message:
-            await self.handle_non_reply_kick()
-        else:
-            await self.message.edit("<b>Unsupported</b>")
+        await self.handle()
 
-    async def handle_reply_kick(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            if self.message.reply_to_message.from_user:
-                self.name = self.message.reply_to_message.from_user.first_name
-                await self.kick_user(self.message.reply_to_message.from_user.id)
-            else:
-                await self.message.edit("<b>Reply on user msg</b>")
-
-    async def handle_non_reply_kick(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            if len(self.cause.split()) > 1:
-                user_to_kick = await self.get_user_to_kick()
-                if user_to_kick:
-                    self.name = (
-                        user_to_kick.first_name
-                        if getattr(user_to_kick, "first_name", None)
-                        else user_to_kick.title
-                    )
-                    await self.kick_user(user_to_kick.id)
-            else:
-                await self.message.edit("<b>user_id or username</b>")
-
-    async def get_user_to_kick(self):
-        user_type = await check_username_or_id(self.cause.split(" ")[1])
-        if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
-        if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
-        await self.message.edit("<b>Invalid user type</b>")
-        return None
-
-    async def kick_user(self, user_id):
-        try:
-            await self.client.ban_chat_member(
-                self.message.chat.id,
-                user_id,
-                datetime.now() + timedelta(minutes=1),
-            )
-            self.channel = await self.client.resolve_peer(self.message.chat.id)
-            self.user_id = await self.client.resolve_peer(user_id)
-            await self.handle_additional_actions()
-            await self.client.unban_chat_member(self.message.chat.id, user_id)
-            await self.edit_message()
-        except UserAdminInvalid:
-            await self.message.edit("<b>No rights</b>")
-        except ChatAdminRequired:
-            await self.message.edit("<b>No rights</b>")
-        except Exception as e:
-            await self.message.edit(format_exc(e))
-
-    async def handle_additional_actions(self):
-        if "report_spam" in self.cause.lower().split():
-            await self.client.invoke(
-                functions.channels.ReportSpam(
-                    channel=self.channel,
-                    participant=self.user_id,
-                    id=[self.message.reply_to_message.id],
-                )
-            )
-        if "delete_history" in self.cause.lower().split():
-            await self.client.invoke(
-                functions.channels.DeleteParticipantHistory(
-                    channel=self.channel, participant=self.user_id
-                )
-            )
-
-    async def edit_message(self):
-        text_c = "".join(
-            f" {_}"
-            for _ in self.cause.split()
-            if _.lower() not in ["delete_history", "report_spam"]
-        )
-        await self.message.edit(
-            f"<b>{self.name}</b> <code>kicked!</code>"
-            + f"\n{'<b>Cause:</b> <i>' + text_c.split(maxsplit=1)[1] + '</i>' if len(text_c.split()) > 1 else ''}"
-        )
+    def make_action(self):
+        return bulk_actions.kick(self.client, self.chat_id)
 
 
 class KickDeletedAccountsHandler:
@@ -343,28 +372,41 @@ class KickDeletedAccountsHandler:
         self.client = client
         self.message = message
         self.chat_id = message.chat.id
-        self.kicked_count = 0
+
+    async def deleted_accounts(self):
+        # the member list can't be resumed, so it's listed again after a
+        # FloodWait, kicked members shift the offsets anyway
+        seen = set()
+        while True:
+            try:
+                async for member in self.client.get_chat_members(self.chat_id):
+                    user = member.user
+                    if user and user.is_deleted and user.id not in seen:
+                        seen.add(user.id)
+                        yield user.id
+                return
+            except FloodWait as e:
+                logging.info("kickdel: FloodWait for %ss listing members", e.value)
+                await asyncio.sleep(e.value)
 
     async def kick_deleted_accounts(self):
         await self.message.edit("<b>Kicking deleted accounts...</b>")
-        try:
-            async for member in self.client.get_chat_members(self.chat_id):
-                if member.user.is_deleted:
-                    await self.kick_member(member.user.id)
-                    self.kicked_count += 1
-        except Exception as e:
-            return await self.message.edit(format_exc(e))
-        await self.message.edit(
-            f"<b>Successfully kicked {self.kicked_count} deleted account(s)</b>",
+        # a ban for more than 30 seconds, so it isn't permanent
+        bulk = BulkAction(
+            f"kickdel{self.chat_id}",
+            bulk_actions.ban(self.client, self.chat_id, timedelta(seconds=31)),
+            self.message,
+            "Kicking deleted accounts",
         )
-
-    async def kick_member(self, user_id):
         try:
-            await self.client.ban_chat_member(
-                self.chat_id, user_id, datetime.now() + timedelta(seconds=31)
-            )
+            result = await bulk.run(self.deleted_accounts())
         except Exception as e:
-            await self.message.edit(f"Failed to kick user {user_id}: {format_exc(e)}")
+            return await self.message.edit(format_exc(e))
+        kicked = result["done"] + result["skipped"]
+        text = f"<b>Successfully kicked {kicked} deleted account(s)</b>"
+        if result["failed"]:
+            text += f"\n<b>Failed to kick {result['failed']} account(s)</b>"
+        await self.message.edit(text)
 
 
 class TimeMuteHandler:
@@ -373,7 +415,7 @@ class TimeMuteHandler:
         self.message = message
         self.cause = text(message)
         self.chat_id = message.chat.id
-        self.tmuted_users = db.get("core.ats", f"c{self.chat_id}", [])
+        self.tmuted_users = db.smembers("core.ats", f"c{self.chat_id}")
 
     async def handle_tmute(self):
         if self.message.reply_to_message:
@@ -389,8 +431,7 @@ class TimeMuteHandler:
             if user_for_tmute in self.tmuted_users:
                 await self.message.edit(f"<b>{name}</b> <code>already in tmute</code>")
             else:
-                self.tmuted_users.append(user_for_tmute)
-                db.set("core.ats", f"c{self.chat_id}", self.tmuted_users)
+                db.sadd("core.ats", f"c{self.chat_id}", user_for_tmute)
                 await self.message.edit(
                     f"<b>{name}</b> <code>in tmute</code>"
                     + f"\n{'<b>Cause:</b> <i>' + self.cause.split(maxsplit=1)[1] + '</i>' if len(self.cause.split()) > 1 else ''}",
@@ -407,8 +448,7 @@ class TimeMuteHandler:
                         else user_to_tmute.title
                     )
                     if user_to_tmute.id not in self.tmuted_users:
-                        self.tmuted_users.append(user_to_tmute.id)
-                        db.set("core.ats", f"c{self.chat_id}", self.tmuted_users)
+                        db.sadd("core.ats", f"c{self.chat_id}", user_to_tmute.id)
                         await self.message.edit(
                             f"<b>{name}</b> <code>in tmute</code>"
                             + f"\n{'<b>Cause:</b> <i>' + self.cause.split(maxsplit=2)[2] + '</i>' if len(self.cause.split()) > 2 else ''}",
@@ -423,9 +463,9 @@ class TimeMuteHandler:
     async def get_user_to_tmute(self):
         user_type = await check_username_or_id(self.cause.split(" ")[1])
         if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
+            return await peer_cache.get_chat(self.client, self.cause.split(" ")[1])
         if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
+            return await peer_cache.get_user(self.client, self.cause.split(" ")[1])
         await self.message.edit("<b>Invalid user type</b>")
         return None
 
@@ -436,7 +476,7 @@ class TimeUnmuteHandler:
         self.message = message
         self.cause = text(message)
         self.chat_id = message.chat.id
-        self.tmuted_users = db.get("core.ats", f"c{self.chat_id}", [])
+        self.tmuted_users = db.smembers("core.ats", f"c{self.chat_id}")
 
     async def handle_tunmute(self):
         if self.message.reply_to_message:
@@ -452,8 +492,7 @@ class TimeUnmuteHandler:
             if user_for_tunmute not in self.tmuted_users:
                 await self.message.edit(f"<b>{name}</b> <code>not in tmute</code>")
             else:
-                self.tmuted_users.remove(user_for_tunmute)
-                db.set("core.ats", f"c{self.chat_id}", self.tmuted_users)
+                db.srem("core.ats", f"c{self.chat_id}", user_for_tunmute)
                 await self.message.edit(
                     f"<b>{name}</b> <code>tunmuted</code>"
                     + f"\n{'<b>Cause:</b> <i>' + self.cause.split(maxsplit=1)[1] + '</i>' if len(self.cause.split()) > 1 else ''}",
@@ -474,8 +513,7 @@ class TimeUnmuteHandler:
                             f"<b>{name}</b> <code>not in tmute</code>",
                         )
                     else:
-                        self.tmuted_users.remove(user_to_tunmute.id)
-                        db.set("core.ats", f"c{self.chat_id}", self.tmuted_users)
+                        db.srem("core.ats", f"c{self.chat_id}", user_to_tunmute.id)
                         await self.message.edit(
                             f"<b>{name}</b> <code>tunmuted</code>"
                             + f"\n{'<b>Cause:</b> <i>' + self.cause.split(maxsplit=2)[2] + '</i>' if len(self.cause.split()) > 2 else ''}",
@@ -486,9 +524,9 @@ class TimeUnmuteHandler:
     async def get_user_to_tunmute(self):
         user_type = await check_username_or_id(self.cause.split(" ")[1])
         if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
+            return await peer_cache.get_chat(self.client, self.cause.split(" ")[1])
         if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
+            return await peer_cache.get_user(self.client, self.cause.split(" ")[1])
         await self.message.edit("<b>Invalid user type</b>")
         return None
 
@@ -498,20 +536,15 @@ class TimeMuteUsersHandler:
         self.client = client
         self.message = message
         self.chat_id = message.chat.id
-        self.tmuted_users = db.get("core.ats", f"c{self.chat_id}", [])
+        self.tmuted_users = db.smembers("core.ats", f"c{self.chat_id}")
 
     async def list_tmuted_users(self):
         if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
             text = f"<b>All users</b> <code>{self.message.chat.title}</code> <b>who are now in tmute</b>\n\n"
             count = 0
-            for user in self.tmuted_users:
-                try:
-                    name = await self.get_user_name(user)
-                    if name:
-                        count += 1
-                        text += f"{count}. <b>{name}</b>\n"
-                except PeerIdInvalid:
-                    pass
+            for name in await self.get_user_names():
+                count += 1
+                text += f"{count}. <b>{name}</b>\n"
             if count == 0:
                 await self.message.edit("<b>No users in tmute</b>")
             else:
@@ -520,26 +553,22 @@ class TimeMuteUsersHandler:
         else:
             await self.message.edit("<b>Unsupported</b>")
 
-    async def get_user_name(self, user_id):
-        try:
-            _name_ = await self.client.get_chat(user_id)
-            if await check_username_or_id(_name_.id) == "channel":
-                channel = await self.client.invoke(
-                    functions.channels.GetChannels(
-                        id=[
-                            types.InputChannel(
-                                channel_id=get_channel_id(_name_.id),
-                                access_hash=0,
-                            )
-                        ]
-                    )
-                )
-                return channel.chats[0].title
-            if await check_username_or_id(_name_.id) == "user":
-                user = await self.client.get_users(_name_.id)
-                return user.first_name
-        except PeerIdInvalid:
-            return None
+    async def get_user_names(self):
+        user_ids, channel_ids = [], []
+        for peer_id in self.tmuted_users:
+            try:
+                peer_type = await check_username_or_id(peer_id)
+            except ValueError:
+                continue
+            if peer_type == "user":
+                user_ids.append(peer_id)
+            elif peer_type == "channel":
+                channel_ids.append(peer_id)
+        users = await peer_cache.get_users(self.client, user_ids)
+        channels = await peer_cache.get_channels(self.client, channel_ids)
+        names = [user.first_name for user in users.values()]
+        names += [channel.title for channel in channels.values()]
+        return names
 
 
 class UnmuteHandler:
@@ -602,9 +631,9 @@ class UnmuteHandler:
     async def get_user_to_unmute(self):
         user_type = await check_username_or_id(self.cause.split(" ")[1])
         if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
+            return await peer_cache.get_chat(self.client, self.cause.split(" ")[1])
         if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
+            return await peer_cache.get_user(self.client, self.cause.split(" ")[1])
         await self.message.edit("<b>Invalid user type</b>")
         return None
 
@@ -620,75 +649,14 @@ class UnmuteHandler:
             await self.message.edit(format_exc(e))
 
 
-class MuteHandler:
-    def __init__(self, client: Client, message: Message):
-        self.client = client
-        self.message = message
-        self.cause = text(message)
-        self.chat_id = message.chat.id
-
+class MuteHandler(MultiTargetHandler):
     async def handle_mute(self):
-        if self.message.reply_to_message:
-            await self.handle_reply_mute()
-        elif not self.message.reply_to_message:
-            await self.handle_non_reply_mute()
-        else:
-            await self.message.edit("<b>Unsupported</b>")
-
-    async def handle_reply_mute(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            user_for_mute = self.message.reply_to_message.from_user
-            if user_for_mute:
-                mute_seconds = self.calculate_mute_seconds()
-                try:
-                    await self.mute_user(user_for_mute.id, mute_seconds)
-                    await self.message.edit(
-                        self.construct_mute_message(user_for_mute, mute_seconds)
-                    )
-                except UserAdminInvalid:
-                    await self.message.edit("<b>No rights</b>")
-                except ChatAdminRequired:
-                    await self.message.edit("<b>No rights</b>")
-                except Exception as e:
-                    await self.message.edit(format_exc(e))
-            else:
-                await self.message.edit("<b>Reply on user msg</b>")
-
-    async def handle_non_reply_mute(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            if len(self.cause.split()) > 1:
-                user_to_mute = await self.get_user_to_mute()
-                if user_to_mute:
-                    mute_seconds = self.calculate_mute_seconds()
-                    try:
-                        await self.mute_user(user_to_mute.id, mute_seconds)
-                        await self.message.edit(
-                            self.construct_mute_message(user_to_mute, mute_seconds)
-                        )
-                    except UserAdminInvalid:
-                        await self.message.edit("<b>No rights</b>")
-                    except ChatAdminRequired:
-                        await self.message.edit("<b>No rights</b>")
-                    except Exception as e:
-                        await self.message.edit(format_exc(e))
-                else:
-                    await self.message.edit("<b>User is not found</b>")
-            else:
-                await self.message.edit("<b>user_id or username</b>")
-
-    async def get_user_to_mute(self):
-        user_type = await check_username_or_id(self.cause.split(" ")[1])
-        if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
-        if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
-        await self.message.edit("<b>Invalid user type</b>")
-        return None
+        await self.handle()
 
     def calculate_mute_seconds(self):
         mute_seconds: int = 0
         for character in "mhdw":
-            match = re.search(rf"(\d+|(\d+\.\d+)){character}", self.message.text)
+            match = re.search(rf"(\d+|(\d+\.\d+)){character}", " ".join(self.args))
             if match:
                 value = float(match.string[match.start() : match.end() - 1])
                 if character == "m":
@@ -701,39 +669,26 @@ class MuteHandler:
                     mute_seconds += int(value * 604800)
         return mute_seconds
 
-    async def mute_user(self, user_id, mute_seconds):
-        try:
-            if mute_seconds > 30:
-                await self.client.restrict_chat_member(
-                    self.chat_id,
-                    user_id,
-                    ChatPermissions(),
-                    datetime.now() + timedelta(seconds=mute_seconds),
-                )
-            else:
-                await self.client.restrict_chat_member(
-                    self.chat_id,
-                    user_id,
-                    ChatPermissions(),
-                )
-        except Exception as e:
-            await self.message.edit(format_exc(e))
+    def make_action(self):
+        mute_seconds = self.calculate_mute_seconds()
+        until = timedelta(seconds=mute_seconds) if mute_seconds > 30 else None
+        return bulk_actions.mute(self.client, self.chat_id, until)
 
-    def construct_mute_message(self, user, mute_seconds):
+    def construct_done_message(self, names: str) -> str:
+        mute_seconds = self.calculate_mute_seconds()
+        if mute_seconds <= 30:
+            return f"<b>{names}</b> <code>was muted forever</code>"
         mute_time: Dict[str, int] = {
-            "days": mute_seconds // 86400,
-            "hours": mute_seconds % 86400 // 3600,
-            "minutes": mute_seconds % 86400 % 3600 // 60,
+            "day": mute_seconds // 86400,
+            "hour": mute_seconds % 86400 // 3600,
+            "minute": mute_seconds % 3600 // 60,
         }
-        message_text = (
-            f"<b>{user.first_name}</b> <code> was muted for"
-            f" {((str(mute_time['days']) + ' day') if mute_time['days'] > 0 else '') + ('s' if mute_time['days'] > 1 else '')}"
-            f" {((str(mute_time['hours']) + ' hour') if mute_time['hours'] > 0 else '') + ('s' if mute_time['hours'] > 1 else '')}"
-            f" {((str(mute_time['minutes']) + ' minute') if mute_time['minutes'] > 0 else '') + ('s' if mute_time['minutes'] > 1 else '')}</code>"
-            + f"\n{'<b>Cause:</b> <i>' + self.cause.split(' ', maxsplit=2)[2] + '</i>' if len(self.cause.split()) > 2 else ''}"
+        duration = " ".join(
+            f"{value} {unit}" + ("s" if value > 1 else "")
+            for unit, value in mute_time.items()
+            if value > 0
         )
-        message_text = " ".join(message_text.split())
-        return message_text
+        return f"<b>{names}</b> <code>was muted for {duration}</code>"
 
 
 class DemoteHandler:
@@ -806,9 +761,9 @@ class DemoteHandler:
     async def get_user_to_demote(self):
         user_type = await check_username_or_id(self.cause.split(" ")[1])
         if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
+            return await peer_cache.get_chat(self.client, self.cause.split(" ")[1])
         if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
+            return await peer_cache.get_user(self.client, self.cause.split(" ")[1])
         await self.message.edit("<b>Invalid user type</b>")
         return None
 
@@ -833,116 +788,38 @@ class DemoteHandler:
         )
 
 
-class PromoteHandler:
-    def __init__(self, client: Client, message: Message):
-        self.client = client
-        self.message = message
-        self.cause = text(message)
-        self.chat_id = message.chat.id
-        self.common_privileges_promote = {
-            "can_delete_messages": True,
-            "can_restrict_members": True,
-            "can_invite_users": True,
-            "can_pin_messages": True,
-        }
+class PromoteHandler(MultiTargetHandler):
+    done_text = "promoted!"
+    common_privileges_promote = {
+        "can_delete_messages": True,
+        "can_restrict_members": True,
+        "can_invite_users": True,
+        "can_pin_messages": True,
+    }
 
     async def handle_promote(self):
-        if self.message.reply_to_message:
-            await self.handle_reply_promote()
-        elif not self.message.reply_to_message:
-            await self.handle_non_reply_promote()
-        else:
-            await self.message.edit("<b>Unsupported</b>")
-
-    async def handle_reply_promote(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            user_for_promote = self.message.reply_to_message.from_user
-            promote_title = (
-                self.message.text.split(maxsplit=1)[1]
-                if len(self.message.text.split()) > 1
-                else None
-            )
-            if promote_title and len(promote_title) > 16:
-                promote_title = promote_title[:16]
-            if user_for_promote:
-                try:
-                    await self.promote_user(user_for_promote.id, promote_title)
-                    await self.message.edit(
-                        self.construct_promote_message(user_for_promote)
-                    )
-                except UserAdminInvalid:
-                    await self.message.edit("<b>No rights</b>")
-                except ChatAdminRequired:
-                    await self.message.edit("<b>No rights</b>")
-                except Exception as e:
-                    await self.message.edit(format_exc(e))
-            else:
-                await self.message.edit("<b>Reply on user msg</b>")
-
-    async def handle_non_reply_promote(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            if len(self.cause.split()) > 1:
-                user_to_promote = await self.get_user_to_promote()
-                promote_title = (
-                    " ".join(self.cause.split(" ")[2:])
-                    if len(self.cause.split(" ")) > 2
-                    else None
-                )
-                if promote_title and len(promote_title) > 16:
-                    promote_title = promote_title[:16]
-                if user_to_promote:
-                    try:
-                        await self.promote_user(user_to_promote.id, promote_title)
-                        await self.message.edit(
-                            self.construct_promote_message(user_to_promote)
-                        )
-                    except UserAdminInvalid:
-                        await self.message.edit("<b>No rights</b>")
-                    except ChatAdminRequired:
-                        await self.message.edit("<b>No rights</b>")
-                    except Exception as e:
-                        await self.message.edit(format_exc(e))
-                else:
-                    await self.message.edit("<b>User is not found</b>")
-            else:
-                await self.message.edit("<b>user_id or username not provided!</b>")
+        await self.handle()
 
-    async def get_user_to_promote(self):
-        user_type = await check_username_or_id(self.cause.split(" ")[1])
-        if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
-        if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
-        await self.message.edit("<b>Invalid user type</b>")
-        return None
+    @property
+    def title(self):
+        return " ".join(self.args)[:16] or None
 
-    async def promote_user(self, user_id, title):
-        try:
-            await self.client.promote_chat_member(
-                self.chat_id,
-                user_id,
-                privileges=ChatPrivileges(**self.common_privileges_promote),
-                title=title,
-            )
-            if len(self.cause.split()) > 1 and self.message.chat.type == "group":
-                await self.client.set_administrator_title(
-                    self.chat_id,
-                    user_id,
-                    self.cause.split(maxsplit=1)[1],
-                )
-        except UserAdminInvalid:
-            raise UserAdminInvalid()
-        except ChatAdminRequired:
-            raise ChatAdminRequired()
-        except Exception as e:
-            await self.message.edit(format_exc(e))
+    def make_action(self):
+        return self.promote_user
 
-    def construct_promote_message(self, user):
-        return (
-            f"<b>{user.first_name}</b> <code>promoted!</code>"
-            + f"\n{'<b>Title:</b> <i>' + self.cause.split(' ', maxsplit=1)[1] + '</i>' if len(self.cause.split()) > 1 else ''}"
+    async def promote_user(self, user_id):
+        await self.client.promote_chat_member(
+            self.chat_id,
+            user_id,
+            privileges=ChatPrivileges(**self.common_privileges_promote),
+            title=self.title,
         )
 
+    def construct_cause(self) -> str:
+        if not self.title:
+            return ""
+        return f"\n<b>Title:</b> <i>{self.title}</i>"
+
 
 class AntiChannelsHandler:
     def __init__(self, client: Client, message: Message):
@@ -978,12 +855,16 @@ class AntiChannelsHandler:
             await self.message.edit("<b>Blocking channels in this chat disabled.</b>")
 
     async def enable_anti_channels(self):
-        db.set("core.ats", f"antich{self.chat_id}", True)
-        group = await self.client.get_chat(self.chat_id)
-        if group.linked_chat:
-            db.set("core.ats", f"linked{self.chat_id}", group.linked_chat.id)
-        else:
-            db.set("core.ats", f"linked{self.chat_id}", 0)
+        group = await peer_cache.get_chat(self.client, self.chat_id)
+        db.set_many(
+            "core.ats",
+            {
+                f"antich{self.chat_id}": True,
+                f"linked{self.chat_id}": (
+                    group.linked_chat.id if group.linked_chat else 0
+                ),
+            },
+        )
         await self.message.edit("<b>Blocking channels in this chat enabled.</b>")
 
     async def disable_anti_channels(self):
@@ -991,87 +872,15 @@ class AntiChannelsHandler:
         await self.message.edit("<b>Blocking channels in this chat disabled.</b>")
 
 
-class DeleteHistoryHandler:
-    def __init__(self, client: Client, message: Message):
-        self.client = client
-        self.message = message
-        self.cause = text(message)
-        self.chat_id = message.chat.id
-        self.prefix = prefix
-
+class DeleteHistoryHandler(MultiTargetHandler):
     async def handle_delete_history(self):
-        if self.message.chat.type not in [ChatType.PRIVATE, ChatType.CHANNEL]:
-            if self.message.reply_to_message:
-                await self.handle_reply_delete_history()
-            elif not self.message.reply_to_message:
-                await self.handle_non_reply_delete_history()
-            else:
-                await self.message.edit("<b>Unsupported</b>")
+        await self.handle()
 
-    async def handle_reply_delete_history(self):
-        if self.message.reply_to_message.from_user:
-            try:
-                user_for_delete, name = await get_user_and_name(self.message)
-                await self.delete_user_history(user_for_delete, name)
-            except UserAdminInvalid:
-                await self.message.edit("<b>No rights</b>")
-            except ChatAdminRequired:
-                await self.message.edit("<b>No rights</b>")
-            except Exception as e:
-                await self.message.edit(format_exc(e))
-        else:
-            await self.message.edit("<b>Reply on user msg</b>")
+    def make_action(self):
+        return bulk_actions.delete_history(self.client, self.chat_id)
 
-    async def handle_non_reply_delete_history(self):
-        if len(self.cause.split()) > 1:
-            try:
-                user_to_delete = await self.get_user_to_delete()
-                if user_to_delete:
-                    name = (
-                        user_to_delete.first_name
-                        if getattr(user_to_delete, "first_name", None)
-                        else user_to_delete.title
-                    )
-                    await self.delete_user_history(user_to_delete.id, name)
-                else:
-                    await self.message.edit("<b>User is not found</b>")
-            except PeerIdInvalid:
-                await self.message.edit("<b>User is not found</b>")
-            except UsernameInvalid:
-                await self.message.edit("<b>User is not found</b>")
-            except IndexError:
-                await self.message.edit("<b>User is not found</b>")
-        else:
-            await self.message.edit("<b>user_id or username</b>")
-
-    async def get_user_to_delete(self):
-        user_type = await check_username_or_id(self.cause.split(" ")[1])
-        if user_type == "channel":
-            return await self.client.get_chat(self.cause.split(" ")[1])
-        if user_type == "user":
-            return await self.client.get_users(self.cause.split(" ")[1])
-        await self.message.edit("<b>Invalid user type</b>")
-        return None
-
-    async def delete_user_history(self, user_id, name):
-        try:
-            channel = await self.client.resolve_peer(self.chat_id)
-            user_id = await self.client.resolve_peer(user_id)
-            await self.client.invoke(
-                functions.channels.DeleteParticipantHistory(
-                    channel=channel, participant=user_id
-                )
-            )
-            await self.message.edit(
-                f"<code>History from <b>{name}</b> was deleted!</code>"
-                + f"\n{'<b>Cause:</b> <i>' + self.cause.split(' ', maxsplit=1)[1] + '</i>' if len(self.cause.split()) > 1 else ''}"
-            )
-        except UserAdminInvalid:
-            await self.message.edit("<b>No rights</b>")
-        except ChatAdminRequired:
-            await self.message.edit("<b>No rights</b>")
-        except Exception as e:
-            await self.message.edit(format_exc(e))
+    def construct_done_message(self, names: str) -> str:
+        return f"<code>History from <b>{names}</b> was deleted!</code>"
 
 
 class AntiRaidHandler:
@@ -1092,12 +901,16 @@ class AntiRaidHandler:
             await self.toggle_antiraid()
 
     async def enable_antiraid(self):
-        db.set("core.ats", f"antiraid{self.chat_id}", True)
-        group = await self.client.get_chat(self.chat_id)
-        if group.linked_chat:
-            db.set("core.ats", f"linked{self.chat_id}", group.linked_chat.id)
-        else:
-            db.set("core.ats", f"linked{self.chat_id}", 0)
+        group = await peer_cache.get_chat(self.client, self.chat_id)
+        db.set_many(
+            "core.ats",
+            {
+                f"antiraid{self.chat_id}": True,
+                f"linked{self.chat_id}": (
+                    group.linked_chat.id if group.linked_chat else 0
+                ),
+            },
+        )
         await self.message.edit(
             "<b>Anti-raid mode enabled!\n"
             f"Disable with: </b><code>{self.prefix}antiraid off</code>"
@@ -1110,21 +923,75 @@ class AntiRaidHandler:
     async def toggle_antiraid(self):
         current_status = db.get("core.ats", f"antiraid{self.chat_id}", False)
         new_status = not current_status
-        db.set("core.ats", f"antiraid{self.chat_id}", new_status)
         if new_status:
-            group = await self.client.get_chat(self.chat_id)
-            if group.linked_chat:
-                db.set("core.ats", f"linked{self.chat_id}", group.linked_chat.id)
-            else:
-                db.set("core.ats", f"linked{self.chat_id}", 0)
+            group = await peer_cache.get_chat(self.client, self.chat_id)
+            db.set_many(
+                "core.ats",
+                {
+                    f"antiraid{self.chat_id}": new_status,
+                    f"linked{self.chat_id}": (
+                        group.linked_chat.id if group.linked_chat else 0
+                    ),
+                },
+            )
             await self.message.edit(
                 "<b>Anti-raid mode enabled!\n"
                 f"Disable with: </b><code>{self.prefix}antiraid off</code>"
             )
         else:
+            db.set("core.ats", f"antiraid{self.chat_id}", new_status)
             await self.message.edit("<b>Anti-raid mode disabled</b>")
 
 
+class PayloadCache:
+    """InputMedia lists of stored media groups
+
+    Entries are keyed by (module, variable, ...) of the note or filter they
+    belong to, dropped when it changes and rebuilt when sending them fails.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._payloads = OrderedDict()
+
+    async def get_media_group(self, client: Client, key: tuple, entry: dict, prepare):
+        source = (int(entry["CHAT_ID"]), int(entry["MESSAGE_ID"]))
+        cached = self._payloads.get(key)
+        if cached is not None and cached[0] == source:
+            self._payloads.move_to_end(key)
+            return cached[1]
+
+        media = prepare(await client.get_media_group(*source))
+        self._payloads[key] = (source, media)
+        if len(self._payloads) > self.max_size:
+            self._payloads.popitem(last=False)
+        return media
+
+    async def send_media_group(
+        self, client: Client, key: tuple, entry: dict, prepare, chat_id, **kwargs
+    ):
+        cached = key in self._payloads
+        media = await self.get_media_group(client, key, entry, prepare)
+        try:
+            return await client.send_media_group(chat_id, media, **kwargs)
+        except RPCError:
+            if not cached:
+                raise
+        # file ids may have gone stale, try once more with fresh ones
+        self._payloads.pop(key, None)
+        media = await self.get_media_group(client, key, entry, prepare)
+        return await client.send_media_group(chat_id, media, **kwargs)
+
+    def drop(self, module: str, variable=None, _=None):
+        for key in list(self._payloads):
+            if key[0] == module and (variable is None or key[1] == variable):
+                del self._payloads[key]
+
+
+payload_cache = PayloadCache()
+db.subscribe("core.notes", payload_cache.drop)
+
+
 class NoteSendHandler:
     def __init__(self, client: Client, message: Message):
         self.client = client
@@ -1140,7 +1007,7 @@ class NoteSendHandler:
             find_note = db.get("core.notes", f"note{note_name}", False)
             if find_note:
                 try:
-                    await self.send_note(find_note)
+                    await self.send_note(find_note, note_name)
                 except RPCError:
                     await self.message.edit(
                         "<b>Sorry, but this note is unavailable.\n\n"
@@ -1154,27 +1021,26 @@ class NoteSendHandler:
                 f"<b>Example: <code>{self.prefix}note note_name</code></b>",
             )
 
-    async def send_note(self, find_note):
+    async def send_note(self, find_note, note_name):
         if find_note.get("MEDIA_GROUP"):
             await self.message.delete()
-            await self.send_media_group(find_note)
+            await self.send_media_group(find_note, note_name)
         else:
             await self.message.delete()
             await self.copy_message(find_note)
 
-    async def send_media_group(self, find_note):
-        messages_grouped = await self.client.get_media_group(
-            int(find_note["CHAT_ID"]), int(find_note["MESSAGE_ID"])
-        )
-        media_grouped_list = self.prepare_media_group(messages_grouped)
+    async def send_media_group(self, find_note, note_name):
+        kwargs = {}
         if self.message.reply_to_message:
-            await self.client.send_media_group(
-                self.message.chat.id,
-                media_grouped_list,
-                reply_to_message_id=self.message.reply_to_message.id,
-            )
-        else:
-            await self.client.send_media_group(self.message.chat.id, media_grouped_list)
+            kwargs["reply_to_message_id"] = self.message.reply_to_message.id
+        await payload_cache.send_media_group(
+            self.client,
+            ("core.notes", f"note{note_name}"),
+            find_note,
+            self.prepare_media_group,
+            self.message.chat.id,
+            **kwargs,
+        )
 
     async def copy_message(self, find_note):
         if self.message.reply_to_message:
@@ -0,0 +1,237 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Union
+
+from pyrogram import Client
+from pyrogram.enums import ChatMembersFilter
+from pyrogram.errors import PeerIdInvalid, RPCError
+from pyrogram.raw import functions, types as raw_types
+from pyrogram.types import Chat, User
+
+_MISSING = object()
+
+
+class PeerCache:
+    """Users, chats and input peers shared by all handlers
+
+    Entries are kept for ``ttl`` seconds. Concurrent lookups of the same peer
+    share one request, and users or channels looked up by id in the same loop
+    iteration are fetched with one users.GetUsers or channels.GetChannels.
+    Administrator ids of chats are kept the same way.
+    """
+
+    def __init__(self, ttl: float = 5 * 60, max_size: int = 2048):
+        self.ttl = ttl
+        self.max_size = max_size
+        # (kind, key) -> (expires, value)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        # kind -> {id: future} waiting for the next batch
+        self._batches = {}
+
+    @staticmethod
+    def _key(peer: Union[int, str]):
+        if isinstance(peer, int):
+            return peer
+        peer = str(peer).strip()
+        if peer.lstrip("-").isdigit():
+            return int(peer)
+        return peer.lstrip("@").lower()
+
+    def _get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, key: tuple, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, peer_id: int = None):
+        """Forget one peer, or everything"""
+        if peer_id is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[1] == peer_id]:
+            del self._entries[key]
+
+    async def _fetch(self, kind: str, peer, fetch):
+        key = (kind, self._key(peer))
+        value = self._get(key)
+        if value is not _MISSING:
+            return value
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.ensure_future(fetch())
+            future.add_done_callback(lambda f: self._fetched(key, f))
+        # a cancelled caller mustn't cancel the lookup other callers wait for
+        return await asyncio.shield(future)
+
+    def _fetched(self, key: tuple, future: asyncio.Future):
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        value = future.result()
+        self._store(key, value)
+        # usernames resolve to the same entity as its id
+        if isinstance(key[1], str) and getattr(value, "id", None) is not None:
+            self._store((key[0], value.id), value)
+
+    async def get_chat(self, client: Client, chat: Union[int, str]) -> Chat:
+        return await self._fetch("chat", chat, lambda: client.get_chat(chat))
+
+    async def resolve_peer(self, client: Client, peer: Union[int, str]):
+        return await self._fetch("peer", peer, lambda: client.resolve_peer(peer))
+
+    async def get_admins(self, client: Client, chat_id: int) -> frozenset:
+        """Get ids of the administrators of a chat"""
+
+        async def fetch():
+            admins = set()
+            async for member in client.get_chat_members(
+                chat_id, filter=ChatMembersFilter.ADMINISTRATORS
+            ):
+                admins.add((member.user or member.chat).id)
+            return frozenset(admins)
+
+        return await self._fetch("admins", chat_id, fetch)
+
+    def update_admin(self, chat_id: int, user_id: int, is_admin: bool):
+        """Apply a promotion or demotion to the cached administrators"""
+        key = ("admins", chat_id)
+        admins = self._get(key)
+        if admins is _MISSING:
+            return
+        if is_admin:
+            self._store(key, admins | {user_id})
+        else:
+            self._store(key, admins - {user_id})
+
+    async def get_user(self, client: Client, user: Union[int, str]) -> User:
+        key = self._key(user)
+        if isinstance(key, str):
+            return await self._fetch("user", key, lambda: client.get_users(user))
+        return await self._batched(client, "user", key)
+
+    async def get_users(self, client: Client, user_ids) -> dict:
+        """Get users by id, ones that can't be found are left out"""
+        return await self._gather(client, "user", user_ids)
+
+    async def get_channels(self, client: Client, channel_ids) -> dict:
+        """Get channels by id, ones that can't be found are left out"""
+        return await self._gather(client, "channel", channel_ids)
+
+    async def _gather(self, client: Client, kind: str, ids) -> dict:
+        ids = [int(peer_id) for peer_id in ids]
+        results = await asyncio.gather(
+            *[self._batched(client, kind, peer_id) for peer_id in ids],
+            return_exceptions=True,
+        )
+        found = {}
+        for peer_id, result in zip(ids, results):
+            if isinstance(result, RPCError):
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            found[peer_id] = result
+        return found
+
+    async def _batched(self, client: Client, kind: str, peer_id: int):
+        key = (kind, peer_id)
+        value = self._get(key)
+        if value is not _MISSING:
+            return value
+
+        future = self._inflight.get(key)
+        if future is None:
+            batch = self._batches.setdefault(kind, {})
+            if not batch:
+                asyncio.get_running_loop().call_soon(self._flush, client, kind)
+            future = self._inflight[key] = batch[peer_id] = (
+                asyncio.get_running_loop().create_future()
+            )
+        return await asyncio.shield(future)
+
+    def _flush(self, client: Client, kind: str):
+        batch = self._batches.pop(kind, {})
+        if batch:
+            asyncio.ensure_future(self._fetch_batch(client, kind, batch))
+
+    async def _fetch_batch(self, client: Client, kind: str, batch: dict):
+        fetch = self._fetch_users if kind == "user" else self._fetch_channels
+        try:
+            try:
+                found = await fetch(client, list(batch))
+            except RPCError:
+                if len(batch) == 1:
+                    raise
+                # one unknown id fails the whole request, find out which
+                found = {}
+                for result in await asyncio.gather(
+                    *[fetch(client, [peer_id]) for peer_id in batch],
+                    return_exceptions=True,
+                ):
+                    if isinstance(result, dict):
+                        found.update(result)
+        except Exception as e:
+            for peer_id, future in batch.items():
+                self._inflight.pop((kind, peer_id), None)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for peer_id, future in batch.items():
+            self._inflight.pop((kind, peer_id), None)
+            if peer_id in found:
+                self._store((kind, peer_id), found[peer_id])
+                future.set_result(found[peer_id])
+            else:
+                future.set_exception(PeerIdInvalid())
+
+    @staticmethod
+    async def _fetch_users(client: Client, user_ids: list) -> dict:
+        return {user.id: user for user in await client.get_users(user_ids)}
+
+    @staticmethod
+    async def _fetch_channels(client: Client, channel_ids: list) -> dict:
+        peers = [await client.resolve_peer(channel_id) for channel_id in channel_ids]
+        r = await client.invoke(
+            functions.channels.GetChannels(
+                id=[
+                    raw_types.InputChannel(
+                        channel_id=peer.channel_id, access_hash=peer.access_hash
+                    )
+                    for peer in peers
+                ]
+            )
+        )
+        chats = [Chat._parse_chat(client, chat) for chat in r.chats]
+        return {chat.id: chat for chat in chats}
+
+
+peer_cache = PeerCache()
@@ -3,11 +3,11 @@
 # @source: https://github.com/radude/rentry/blob/master/rentry.py
 import asyncio
 import http.cookiejar
+import urllib.error
 import urllib.parse
 import urllib.request
 
-from uuid import uuid4
-from datetime import datetime, timedelta
+from datetime import datetime
 from http.cookies import SimpleCookie
 from json import loads as json_loads
 
@@ -18,6 +18,12 @@ BASE_URL = "rentry.co"
 
 _headers = {"Referer": f"{BASE_PROTOCOL}{BASE_URL}"}
 
+# pastes that aren't permanent are deleted after this many seconds
+PASTE_TTL = 24 * 60 * 60
+# a failed delete is retried after an hour, doubling every time, this many times
+PASTE_DELETE_ATTEMPTS = 5
+PASTE_RETRY_DELAY = 60 * 60
+
 
 class UrllibClient:
     """Simple HTTP Session Client, keeps cookies."""
@@ -144,57 +150,79 @@ async def paste(
 
     if not permanent:
         short_url = response["url_short"]
-        time_now = datetime.now()
-        ftime = time_now.strftime("%d %I:%M:%S %p %Y")
+        ftime = datetime.now().strftime("%d %I:%M:%S %p %Y")
 
         print(f"URL: {url} - Edit Code: {edit_code} - Time: {ftime}")
 
-        rallUrls = db.get("core.rentry", "urls", default={"allUrls": {}})
-        entry_id = str(uuid4())
-        rallUrls["allUrls"][entry_id] = {
-            "url": short_url,
-            "edit_code": edit_code,
-            "time": ftime,
-        }
-        db.set("core.rentry", "urls", rallUrls)
+        await db.aset(
+            "core.rentry",
+            f"paste_{short_url}",
+            {"url": short_url, "edit_code": edit_code},
+            ttl=PASTE_TTL,
+        )
 
     if return_edit:
         return (url, edit_code)
     return url
 
 
-async def rentry_cleanup_job():
-    """Periodically checks and deletes rentry pastes older than 24 hours"""
-    while True:
-        try:
-            rallUrls = db.get("core.rentry", "urls", default={"allUrls": {}})
-            now = datetime.now()
-            deleted_count = 0
-            error_count = 0
-
-            for entry_id, entry in list(rallUrls["allUrls"].items()):
-                url = entry["url"]
-                entry_time = datetime.strptime(entry["time"], "%d %I:%M:%S %p %Y")
-
-                if now - entry_time > timedelta(days=1):
-                    try:
-                        delete(url, entry["edit_code"])
-                        del rallUrls["allUrls"][entry_id]
-                        deleted_count += 1
-                        print(f"[#] Deleted expired rentry paste: {url}")
-                    except Exception as e:
-                        error_count += 1
-                        print(f"[!] Failed to delete rentry paste {url}: {str(e)}")
-
-            if deleted_count or error_count:
-                print(
-                    f"[*] Cleanup summary: {deleted_count} deleted, {error_count} failed"
-                )
-
-            if deleted_count:
-                db.set("core.rentry", "urls", rallUrls)
-
-        except Exception as e:
-            print(f"[!] Error in rentry cleanup job: {str(e)}")
-
-        await asyncio.sleep(12 * 60 * 60)
+def _paste_gone(response: dict) -> bool:
+    content = str(response.get("content", "")).lower()
+    return (
+        response.get("status") == "404"
+        or "not exist" in content
+        or "not found" in content
+    )
+
+
+async def delete_expired_paste(module, variable, entry):
+    """Deletes a rentry paste once its key expires
+
+    A failed delete keeps the key with a growing ttl, so the reaper retries
+    it later, until PASTE_DELETE_ATTEMPTS is reached.
+    """
+    if not entry or "url" not in entry:
+        return
+    url = entry["url"]
+    try:
+        response = await asyncio.to_thread(delete, url, entry.get("edit_code", ""))
+    except urllib.error.HTTPError as e:
+        response = {"status": str(e.code), "content": e.reason}
+    except Exception as e:
+        response = {"status": None, "content": str(e)}
+
+    if response.get("status") == "200":
+        print(f"[#] Deleted expired rentry paste: {url}")
+        return
+    if _paste_gone(response):
+        print(f"[#] Expired rentry paste {url} no longer exists")
+        return
+
+    attempts = entry.get("attempts", 0) + 1
+    print(
+        f"[!] Failed to delete rentry paste {url}: "
+        f"{response.get('content', 'No message provided')}"
+    )
+    if attempts >= PASTE_DELETE_ATTEMPTS:
+        print(f"[!] Giving up on rentry paste {url} after {attempts} attempts")
+        return
+    await db.aset(
+        module,
+        variable,
+        {**entry, "attempts": attempts},
+        ttl=PASTE_RETRY_DELAY * 2 ** (attempts - 1),
+    )
+
+
+# pastes used to be tracked in a single "urls" dict, and the time stored
+# there has no month, so give them a full day from now
+if legacy_urls := db.get("core.rentry", "urls"):
+    with db.transaction():
+        for entry in legacy_urls["allUrls"].values():
+            db.set(
+                "core.rentry",
+                f"paste_{entry['url']}",
+                {"url": entry["url"], "edit_code": entry["edit_code"]},
+                ttl=PASTE_TTL,
+            )
+        db.remove("core.rentry", "urls")
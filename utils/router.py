@@ -0,0 +1,217 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import inspect
+from typing import Optional
+
+from pyrogram import Client, ContinuePropagation
+from pyrogram.filters import AndFilter, Filter
+from pyrogram.handlers import MessageHandler
+from pyrogram.types import Message
+
+# same argument splitting as filters.command
+COMMAND_RE = re.compile(r"([\"'])(.*?)(?<!\\)\1|(\S+)")
+WORD_RE = re.compile(r"\S+")
+PLAIN_COMMAND = re.compile(r"[\w-]+")
+
+
+class Route:
+    __slots__ = (
+        "handler",
+        "callback",
+        "filters",
+        "command",
+        "prefixes",
+        "case_sensitive",
+        "module",
+    )
+
+    def __init__(self, handler, filters, command, prefixes, case_sensitive, module):
+        self.handler = handler
+        # pyrofork wraps the callback to resolve listeners, the router's own
+        # handler already does that
+        self.callback = getattr(handler, "original_callback", handler.callback)
+        self.filters = filters
+        self.command = command
+        self.prefixes = prefixes
+        self.case_sensitive = case_sensitive
+        self.module = module
+
+
+def split_command_filter(flt: Filter):
+    """Find filters.command in a chain of & and return it with the remaining filter"""
+    if type(flt).__name__ == "CommandFilter":
+        return flt, None
+    if isinstance(flt, AndFilter):
+        command, rest = split_command_filter(flt.base)
+        if command is not None:
+            return command, flt.other if rest is None else rest & flt.other
+        command, rest = split_command_filter(flt.other)
+        if command is not None:
+            return command, flt.base if rest is None else flt.base & rest
+    return None, None
+
+
+class CommandRouter:
+    """Dispatch commands of all modules from one handler per group
+
+    Instead of every command handler checking filters.command on every
+    message, the prefix and command are parsed once and looked up in a dict.
+    """
+
+    def __init__(self):
+        # group -> command -> routes
+        self._routes = {}
+        self._handlers = {}
+        self._prefixes = {}
+
+    def add_handler(
+        self, client: Client, handler, group: int, module: str = None
+    ) -> bool:
+        """Route a handler, returns False if it should be added to the client"""
+        if not isinstance(handler, MessageHandler):
+            return False
+        command_filter, rest = split_command_filter(handler.filters)
+        if command_filter is None or not all(
+            PLAIN_COMMAND.fullmatch(command) for command in command_filter.commands
+        ):
+            return False
+
+        routes = self._routes.setdefault(group, {})
+        for command in command_filter.commands:
+            entries = routes.setdefault(command.lower(), [])
+            if any(route.handler is handler for route in entries):
+                continue
+            entries.append(
+                Route(
+                    handler,
+                    rest,
+                    command,
+                    command_filter.prefixes,
+                    command_filter.case_sensitive,
+                    module,
+                )
+            )
+            for prefix in command_filter.prefixes:
+                self._prefixes[prefix] = self._prefixes.get(prefix, 0) + 1
+
+        if group not in self._handlers:
+            self._handlers[group] = MessageHandler(self._make_dispatch(group))
+            client.add_handler(self._handlers[group], group)
+        return True
+
+    def remove_handler(self, client: Client, handler, group: int) -> bool:
+        """Remove a routed handler, returns False if it was never routed"""
+        if not isinstance(handler, MessageHandler):
+            return False
+        routes = self._routes.get(group, {})
+        removed = False
+        for command, entries in list(routes.items()):
+            for route in [r for r in entries if r.handler is handler]:
+                entries.remove(route)
+                removed = True
+                for prefix in route.prefixes:
+                    self._prefixes[prefix] -= 1
+                    if not self._prefixes[prefix]:
+                        del self._prefixes[prefix]
+            if not entries:
+                del routes[command]
+
+        if not routes and group in self._handlers:
+            client.remove_handler(self._handlers.pop(group), group)
+            self._routes.pop(group, None)
+        return removed
+
+    def find(self, command: str) -> Optional[str]:
+        """Get the module a command belongs to"""
+        for routes in self._routes.values():
+            for route in routes.get(command.lower(), []):
+                return route.module
+        return None
+
+    def _match(self, client: Client, message: Message, group: int):
+        """Yield routes matching the message and their message.command"""
+        text = message.text or message.caption
+        if not text:
+            return
+        routes = self._routes.get(group, {})
+        username = client.me.username or ""
+
+        for prefix in list(self._prefixes):
+            if not text.startswith(prefix):
+                continue
+            without_prefix = text[len(prefix) :]
+            word = WORD_RE.match(without_prefix)
+            if word is None:
+                continue
+
+            token = word.group()
+            names = [token]
+            if username and token.lower().endswith(username.lower()):
+                name = token[: -len(username)]
+                names.append(name[:-1] if name.endswith("@") else name)
+
+            for name in names:
+                entries = routes.get(name.lower())
+                if not entries:
+                    continue
+                # drop the command and one whitespace after it
+                without_command = without_prefix[word.end() + 1 :]
+                args = [
+                    re.sub(r"\\([\"'])", r"\1", m.group(2) or m.group(3) or "")
+                    for m in COMMAND_RE.finditer(without_command)
+                ]
+                for route in entries:
+                    if prefix not in route.prefixes:
+                        continue
+                    if route.case_sensitive and name != route.command:
+                        continue
+                    yield route, [route.command] + args
+                break
+
+    @staticmethod
+    async def _check(flt, client: Client, message: Message) -> bool:
+        if not callable(flt):
+            return True
+        if inspect.iscoroutinefunction(flt.__call__):
+            return await flt(client, message)
+        return await client.loop.run_in_executor(client.executor, flt, client, message)
+
+    def _make_dispatch(self, group: int):
+        async def dispatch(client: Client, message: Message):
+            for route, command in self._match(client, message, group):
+                message.command = command
+                if not await self._check(route.filters, client, message):
+                    continue
+                try:
+                    if inspect.iscoroutinefunction(route.callback):
+                        await route.callback(client, message)
+                    else:
+                        await client.loop.run_in_executor(
+                            client.executor, route.callback, client, message
+                        )
+                except ContinuePropagation:
+                    continue
+                return
+
+            message.command = None
+            raise ContinuePropagation
+
+        return dispatch
+
+
+router = CommandRouter()
@@ -31,13 +31,15 @@ from typing import Dict, Tuple
 
 import psutil
 from pyrogram import Client, errors, filters
-from pyrogram.errors import FloodWait, MessageNotModified, UserNotParticipant
+from pyrogram.errors import FloodWait, MessageNotModified
+from pyrogram.raw.functions.account import GetAuthorizations
 from pyrogram.types import Message
-from pyrogram.enums import ChatMembersFilter
 
 from utils.db import db
 
 from .misc import modules_help, prefix, requirements_list
+from .peers import peer_cache
+from .router import router
 
 META_COMMENTS = re.compile(r"^ *# *meta +(\S+) *: *(.*?)\s*$", re.MULTILINE)
 interact_with_to_delete = []
@@ -219,9 +221,26 @@ def restart() -> None:
             music_bot_process.terminate()
         except psutil.NoSuchProcess:
             print("Music bot is not running.")
+    db.flush()
     os.execvp(sys.executable, [sys.executable, "main.py"]) # skipcq
 
 
+async def save_authorizations(client: Client):
+    """Remember the current sessions, sessionkiller resets any new one"""
+    authorizations = (await client.invoke(GetAuthorizations())).authorizations
+    with db.transaction():
+        db.srem(
+            "core.sessionkiller",
+            "auths_hashes",
+            *db.smembers("core.sessionkiller", "auths_hashes"),
+        )
+        db.sadd(
+            "core.sessionkiller",
+            "auths_hashes",
+            *[auth.hash for auth in authorizations],
+        )
+
+
 def format_exc(e: Exception, suffix="") -> str:
     traceback.print_exc()
     err = traceback.format_exc()
@@ -245,22 +264,19 @@ def with_reply(func):
 
 def is_admin(func):
     async def wrapped(client: Client, message: Message):
+        sender = message.from_user or message.sender_chat
         try:
-            chat_member = await client.get_chat_member(
-                message.chat.id, message.from_user.id
-            )
-            chat_admins = []
-            async for member in client.get_chat_members(
-                message.chat.id, filter=ChatMembersFilter.ADMINISTRATORS
-            ):
-                chat_admins.append(member)
-            if chat_member in chat_admins:
-                return await func(client, message)
-            await message.edit("You need to be an admin to perform this action.")
-        except UserNotParticipant:
-            await message.edit(
+            admins = await peer_cache.get_admins(client, message.chat.id)
+        except errors.UserNotParticipant:
+            return await message.edit(
                 "You need to be a participant in the chat to perform this action."
             )
+        except errors.RPCError as e:
+            return await message.edit(format_exc(e))
+        # anonymous admins send as the chat itself
+        if sender is not None and (sender.id in admins or sender.id == message.chat.id):
+            return await func(client, message)
+        await message.edit("You need to be an admin to perform this action.")
 
     return wrapped
 
@@ -443,6 +459,7 @@ async def load_module(
 
     packages = meta.get("requires", "").split()
     requirements_list.extend(packages)
+    help_before = set(modules_help)
 
     try:
         module = importlib.import_module(path)
@@ -485,10 +502,13 @@ async def load_module(
 
         module = importlib.import_module(path)
 
+    # commands are routed by the name they have in modules_help
+    help_name = next(iter(modules_help.keys() - help_before), module_name)
     for _name, obj in vars(module).items():
         if isinstance(getattr(obj, "handlers", []), list):
             for handler, group in getattr(obj, "handlers", []):
-                client.add_handler(handler, group)
+                if not router.add_handler(client, handler, group, help_name):
+                    client.add_handler(handler, group)
 
     module.__meta__ = meta
 
@@ -504,7 +524,8 @@ async def unload_module(module_name: str, client: Client) -> bool:
 
     for _name, obj in vars(module).items():
         for handler, group in getattr(obj, "handlers", []):
-            client.remove_handler(handler, group)
+            if not router.remove_handler(client, handler, group):
+                client.remove_handler(handler, group)
 
     del modules_help[module_name]
     del sys.modules[path]